@@ -1,13 +1,48 @@
-import json
+from __future__ import annotations
+
+import sys
 from argparse import ArgumentParser, FileType
+from contextlib import nullcontext
 from ipaddress import IPv4Address
-from typing import List
+from typing import List, Dict, Any, TYPE_CHECKING
+
+from .client import DaemonClient, DaemonError, default_socket_path
+from .config import validate_mac, validate_mapping, validate_network, \
+    validate_address, validate_args, CliConfig, __ALL, ALL_INTERFACES, Command, out_ntoa
+
+# Driver modules are imported only by commands which use them,
+# this keeps startup time low when CLI is called from scripts
+if TYPE_CHECKING:
+    from driver import HDMIMatrix
+    from driver.capture import Capture
+    from driver.discovery import NetworkExplorer
+    from driver.protocol import UDPPacket
+    from driver.tracing import ChromeTracer
+    from .devices import DeviceCache
+
+_CACHED_CONNECT_TIMEOUT = 1.0
+# state fields of watch events are named the same way as in status output
+_WATCH_FIELDS = {'mapping': 'mapping', 'input': 'inputs', 'output': 'outputs'}
+
+_tracer: ChromeTracer = None
 
-from driver import HDMIMatrix
-from driver.discovery import NetworkExplorer
-from driver.protocol import UDPPacket, TCP_PORT
-from .config import validate_mac, validate_mapping, \
-    validate_args, CliConfig, __ALL, Command, out_ntoa
+
+def _phase(name: str, **args):
+    """:returns span of CLI phase, no-op context if tracing is disabled"""
+    if _tracer is None:
+        return nullcontext()
+    from driver.tracing import span
+    return span(name, 'cli', **args)
+
+
+def _start_tracing(path: str) -> None:
+    """Records spans of whole run, they are saved when process exits"""
+    global _tracer
+    import atexit
+    from driver.tracing import ChromeTracer, set_tracer
+    _tracer = ChromeTracer()
+    set_tracer(_tracer)
+    atexit.register(_tracer.save, path)
 
 
 class MatrixController(object):
@@ -15,25 +50,129 @@ class MatrixController(object):
     explorer: NetworkExplorer = None
     devices: List[UDPPacket] = None
     device: HDMIMatrix = None
+    cache: DeviceCache = None
+    capture: Capture = None
+
+    _discovery: Any = None
 
     def __init__(self, cfg: CliConfig):
         self.config = cfg
         self.devices = []
+        if cfg.cache_ttl and cfg.device is None:
+            from .devices import DeviceCache, default_cache_path
+            self.cache = DeviceCache(default_cache_path(), cfg.cache_ttl)
+            self.cache.load()
+        if cfg.capture is not None:
+            import atexit
+            from driver.capture import Capture
+            self.capture = Capture(cfg.capture)
+            atexit.register(self.capture.close)
 
     def start(self):
+        if self.config.command is Command.Daemon:
+            self._run_daemon()
+            return
+
+        if not self.config.no_daemon \
+                and self.config.command not in (Command.Batch, Command.Watch):
+            client = DaemonClient(self.config.socket or default_socket_path())
+            with _phase('daemon'):
+                if client.available():
+                    try:
+                        self._run_remote(client)
+                    except DaemonError as e:
+                        print(f"Daemon error: {e}", file=sys.stderr)
+                        sys.exit(1)
+                    return
+
         if self.config.command is Command.Scan \
                 or self.config.device is None:
-            self._start_explorer()
+            if not self._run_cached():
+                self._start_explorer()
         else:
             self._run_command(self.config.device)
 
+    def _run_cached(self) -> bool:
+        """
+        Tries to connect to device with IP address known from previous
+        discovery, only if device is selected by MAC address.
+        :returns True if command was run on cached device
+        """
+        if self.cache is None or self.config.command is Command.Scan \
+                or self.config.device_mac is None:
+            return False
+        data = self.cache.get(self.config.device_mac)
+        if data is None:
+            return False
+        try:
+            self._connect(data.devIP, _CACHED_CONNECT_TIMEOUT)
+        except OSError:
+            self.cache.remove(data.mac)
+            self.cache.save()
+            return False
+        self._execute()
+        return True
+
+    def _run_daemon(self):
+        import signal
+        from .daemon import MatrixDaemon
+        daemon = MatrixDaemon(self.config.socket or default_socket_path(),
+                              str(self.config.bind_to), self.config.num_req,
+                              self.config.log_udp, self.config.log_tcp,
+                              bool(self.config.pipeline),
+                              self.config.sweep, self.config.rate,
+                              self.config.interfaces, self.config.metrics,
+                              self.capture, self.config.timeout)
+        daemon.logging(self.config.log_tcp)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            pass
+
+    def _run_remote(self, client: DaemonClient):
+        if self.config.command is Command.Scan:
+            from .devices import device_from_dict
+            for data in client.request('scan'):
+                print(device_from_dict(data))
+            return
+
+        device = str(self.config.device) if self.config.device else None
+        target = {"device": device, "device_mac": self.config.device_mac}
+        if self.config.command is Command.Status:
+            res = client.request('status', **target)
+            res = {k: {int(p): v for p, v in d.items()} for k, d in res.items()}
+            self._print_status(res['mapping'], res['inputs'], res['outputs'])
+        elif self.config.command is Command.Control and self.config.scene is not None:
+            scene = self.config.scenes[self.config.scene]
+            client.request('scene', name=scene.name, mapping=scene.mapping, **target)
+        elif self.config.command is Command.Control:
+            client.request('control', mapping=self._requested_mapping(), **target)
+
     def _start_explorer(self):
+        from driver import tracing
+        from driver.discovery import NetworkExplorer
+        if self.config.command is not Command.Scan:
+            # ends when device is found, scan is traced by discovery rounds
+            self._discovery = tracing.begin('discovery', 'cli')
         self.explorer = NetworkExplorer(self._on_device_found)
         self.explorer.logging(self.config.log_udp)
         self.explorer.retry_count(self.config.num_req)
-        self.explorer.start(str(self.config.bind_to))
+        self.explorer.capture(self.capture)
+        self.explorer.sweep(self.config.sweep, self.config.rate)
+        if self.config.command is Command.Scan:
+            self.explorer.expect(count=self.config.expect)
+        elif self.config.device_mac is not None:
+            self.explorer.expect(mac=self.config.device_mac)
+        else:
+            self.explorer.expect(count=1)
+        self.explorer.start(str(self.config.bind_to), self.config.interfaces)
 
     def _on_device_found(self, data: UDPPacket) -> None:
+        if self.cache is not None:
+            self.cache.put(data)
+            self.cache.save()
+
         if self.config.command is Command.Scan:
             if data not in self.devices:
                 print(data)
@@ -45,31 +184,60 @@ class MatrixController(object):
             return
 
         self.explorer.stop()
+        from driver import tracing
+        tracing.end(self._discovery, device=str(data.devIP))
         self._run_command(data.devIP)
 
     def _run_command(self, addr: IPv4Address):
+        self._connect(addr)
+        self._execute()
+
+    def _connect(self, addr: IPv4Address, timeout: float = None):
+        from driver import HDMIMatrix
+        from driver.protocol import TCP_PORT
         self.device = HDMIMatrix((addr, TCP_PORT))
         self.device.logging(self.config.log_tcp)
-        self.device.connect()
-
-        if self.config.command is Command.Status:
-            self._query_status()
-        elif self.config.command is Command.Control:
-            self._control_device()
-
-        self.device.disconnect()
+        self.device.pipelining(bool(self.config.pipeline))
+        self.device.capture(self.capture)
+        self.device.timeouts(request=self.config.timeout)
+        with _phase('connect', device=str(addr)):
+            self.device.connect(timeout)
+
+    def _execute(self):
+        failed = 0
+        try:
+            with _phase(self.config.command.value):
+                if self.config.command is Command.Status:
+                    self._query_status()
+                elif self.config.command is Command.Control:
+                    self._control_device()
+                elif self.config.command is Command.Batch:
+                    failed = self._run_batch()
+                elif self.config.command is Command.Watch:
+                    self._watch()
+        finally:
+            if self.device.is_connected():
+                with _phase('disconnect'):
+                    self.device.disconnect()
+        if failed:
+            sys.exit(1)
 
     def _query_status(self) -> None:
         mapping = self.device.get_port_mapping()
         inputs = self.device.get_inputs_status()
         outputs = self.device.get_outputs_status()
+        with _phase('output'):
+            self._print_status(mapping, inputs, outputs)
 
+    def _print_status(self, mapping: Dict[int, int], inputs: Dict[int, bool],
+                      outputs: Dict[int, bool]) -> None:
         conv = str if self.config.numeric else out_ntoa
         mapping = {conv(o): i for o, i in mapping.items()}
         inputs = {str(o): s for o, s in inputs.items()}
         outputs = {conv(o): s for o, s in outputs.items()}
 
         if self.config.json:
+            import json
             res = {"mapping": mapping,
                    "inputs": inputs,
                    "outputs": outputs}
@@ -105,12 +273,58 @@ class MatrixController(object):
         print(str_in)
         print()
 
+    def _run_batch(self) -> int:
+        from .batch import BatchRunner
+        runner = BatchRunner(self.device, bool(self.config.numeric),
+                             self.config.scenes, bool(self.config.pipeline))
+        with self.config.file:
+            return runner.run(self.config.file, sys.stdout)
+
+    def _watch(self) -> None:
+        import json
+        import time
+        from driver.watch import StateWatcher
+
+        def on_change(changes: Dict[str, Dict[int, Any]]) -> None:
+            event = {"time": round(time.time(), 3)}
+            for field, values in changes.items():
+                conv = str if field == 'input' or self.config.numeric else out_ntoa
+                event[_WATCH_FIELDS[field]] = {conv(p): v for p, v in values.items()}
+            print(json.dumps(event), flush=True)
+
+        watcher = StateWatcher(self.device, on_change)
+        watcher.logging(self.config.log_tcp)
+        watcher.intervals(self.config.min_interval, self.config.max_interval)
+        server = None
+        if self.config.metrics is not None:
+            from driver.metrics import Metrics, MetricsServer
+            registry = Metrics()
+            self.device.metrics(registry)
+            server = MetricsServer(registry)
+            server.logging(self.config.log_tcp)
+            server.start(self.config.metrics)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.stop()
+        finally:
+            if server is not None:
+                server.stop()
+
     def _control_device(self) -> None:
-        for mapping in self.config.map:
-            if mapping.dst == config.ALL_NUM:
-                self.device.map_all(mapping.src)
-                return
-            self.device.map_port(mapping.src, mapping.dst)
+        if self.config.scene is not None:
+            self.device.recall(self.config.scenes[self.config.scene])
+        else:
+            self.device.apply_mapping(self._requested_mapping())
+
+    def _requested_mapping(self) -> Dict[int, int]:
+        from driver import HDMIMatrix
+        mapping = {}
+        for group in self.config.map:
+            if group.dst == config.ALL_NUM:
+                return {o + 1: group.src for o in range(HDMIMatrix.num_out)}
+            mapping[group.dst] = group.src
+        return mapping
 
 
 def create_cli() -> ArgumentParser:
@@ -132,6 +346,19 @@ def create_cli() -> ArgumentParser:
                               'if specified, options --bind-to, --device, ' +
                               '--device-mac and --logging will be ignored ' +
                               'and loaded from config')
+    options.add_argument('-S', '--socket', type=str, metavar='PATH',
+                         help='path to daemon socket, default is ' +
+                              'drhd.sock in $XDG_RUNTIME_DIR or temp directory')
+    options.add_argument('--trace', type=str, metavar='FILE',
+                         help='write timeline of connection, requests and ' +
+                              'discovery rounds to FILE in Chrome trace ' +
+                              'format, open it in chrome://tracing or Perfetto')
+    options.add_argument('--capture', type=str, metavar='FILE',
+                         help='append every sent and received packet to FILE, ' +
+                              'inspect or replay it with python -m driver.replay')
+    options.add_argument('--no-daemon', action='store_true',
+                         help='do not use running daemon, always scan and ' +
+                              'connect to device directly')
 
     connect = ArgumentParser(add_help=False, allow_abbrev=False)
     dev_sel = connect.add_mutually_exclusive_group(required=True)
@@ -145,6 +372,13 @@ def create_cli() -> ArgumentParser:
     dev_sel.add_argument('-M', '--device-mac', type=validate_mac, metavar='DEV_MAC',
                          help='device MAC address, if specified we will try ' +
                               'to find device with this MAC in local network')
+    connect.add_argument('--timeout', type=float, metavar='SEC', default=5.0,
+                         help='max time to wait for every reply, queries ' +
+                              'are retried after timeout, default is %(default)s')
+    connect.add_argument('-p', '--pipeline', action='store_true',
+                         help='send all port queries at once instead of one by one, ' +
+                              'falls back to one by one mode if device does not ' +
+                              'support it')
 
     network = ArgumentParser(add_help=False, allow_abbrev=False)
     network.add_argument('-b', '--bind-to', type=IPv4Address,
@@ -152,14 +386,37 @@ def create_cli() -> ArgumentParser:
                          help='bind to specific IP address instead of %(default)s ' +
                               'when scanning for devices, useful when you want ' +
                               'to scan only specific network interface')
+    network.add_argument('-i', '--interface', type=str, metavar='IFACE', nargs='+',
+                         help='broadcast from given interfaces (names or ' +
+                              f'addresses) at once, {ALL_INTERFACES} means every ' +
+                              'interface, overrides --bind-to')
     network.add_argument('-r', '--num-req', type=int, metavar='NUM', default=3,
                          help='number of requests sent to network, ' +
                               'default is %(default)s')
+    network.add_argument('-t', '--cache-ttl', type=float, metavar='SEC', default=86400,
+                         help='how long IP address of device found by MAC is ' +
+                              'reused without scanning, 0 disables cache, ' +
+                              'default is %(default)s')
+    network.add_argument('-w', '--sweep', type=validate_network, metavar='CIDR',
+                         nargs='+', help='instead of broadcast, send request to ' +
+                                         'every host of given networks, useful ' +
+                                         'when device is behind router')
+    network.add_argument('--rate', type=float, metavar='PPS', default=5000,
+                         help='max requests per second in sweep mode, ' +
+                              'default is %(default)s')
+
+    exporter = ArgumentParser(add_help=False, allow_abbrev=False)
+    exporter.add_argument('--metrics', type=validate_address, metavar='[HOST:]PORT',
+                          help='serve command latency and error counters in ' +
+                               'OpenMetrics format at http://HOST:PORT/metrics, ' +
+                               'host defaults to 127.0.0.1')
 
     commands = parser.add_subparsers(dest='command', metavar='COMMAND',
                                      required=True, title='possible commands')
     scan = commands.add_parser('scan', help='scan local network for devices',
                                parents=[network])
+    scan.add_argument('-e', '--expect', type=int, metavar='NUM',
+                      help='stop scanning as soon as NUM devices are found')
 
     status = commands.add_parser('status', help='query device status',
                                  parents=[network, connect])
@@ -171,13 +428,51 @@ def create_cli() -> ArgumentParser:
 
     control = commands.add_parser('control', help='manage device',
                                   parents=[network, connect])
-    control.add_argument('-m', '--map', type=validate_mapping, metavar='O:I',
-                         required=True, nargs='+',
-                         help='map [O]utputs to [I]nputs, output numbers can be ' +
-                              'present in both numerical and alphabetical format, ' +
-                              'output 1 is A, output 2 is B, etc. To map specific input ' +
-                              f'to all outputs use {__ALL} instead of output number, ' +
-                              'in this case only one mapping group should be specified')
+    action = control.add_mutually_exclusive_group(required=True)
+    action.add_argument('-m', '--map', type=validate_mapping, metavar='O:I',
+                        nargs='+',
+                        help='map [O]utputs to [I]nputs, output numbers can be ' +
+                             'present in both numerical and alphabetical format, ' +
+                             'output 1 is A, output 2 is B, etc. To map specific input ' +
+                             f'to all outputs use {__ALL} instead of output number, ' +
+                             'in this case only one mapping group should be specified')
+    action.add_argument('-s', '--scene', type=str, metavar='NAME',
+                        help='apply scene with given name from config file ' +
+                             'using single request')
+
+    batch = commands.add_parser('batch', help='run commands from file or stdin ' +
+                                              'over single connection',
+                                parents=[network, connect])
+    batch.add_argument('-f', '--file', type=FileType('r'), metavar='FILE', default='-',
+                       help='file with one command per line, default is stdin, ' +
+                            'commands are: map O:I [O:I ...], scene NAME, status, ' +
+                            'edid set IN|* VALUE, edid copy OUT IN|*, beep [on|off]')
+    batch.add_argument('-n', '--numeric', action='store_true',
+                       help='use numeric notation for outputs instead of ' +
+                            'alphabetical')
+
+    watch = commands.add_parser('watch', help='keep connection open and print ' +
+                                              'device state changes as JSON lines',
+                                parents=[network, connect, exporter])
+    watch.add_argument('--min-interval', type=float, metavar='SEC', default=0.25,
+                       help='poll interval right after change, ' +
+                            'default is %(default)s')
+    watch.add_argument('--max-interval', type=float, metavar='SEC', default=5.0,
+                       help='poll interval when nothing changes for a long time, ' +
+                            'default is %(default)s')
+    watch.add_argument('-n', '--numeric', action='store_true',
+                       help='use numeric notation for outputs instead of ' +
+                            'alphabetical')
+
+    daemon = commands.add_parser('daemon', help='run in background, keep found ' +
+                                                'devices and connections to them ' +
+                                                'and serve other commands',
+                                 parents=[network, exporter])
+    daemon.add_argument('-p', '--pipeline', action='store_true',
+                        help='send all port queries at once instead of one by one')
+    daemon.add_argument('--timeout', type=float, metavar='SEC', default=5.0,
+                        help='max time to wait for every reply, queries ' +
+                             'are retried after timeout, default is %(default)s')
 
     return parser
 
@@ -185,12 +480,15 @@ def create_cli() -> ArgumentParser:
 def main() -> None:
     parser = create_cli()
     args = parser.parse_args()
-    validate_args(args, parser)
-    try:
-        cfg = CliConfig(args)
-    except Exception as e:
-        parser.error(str(e))
-        exit()
-
-    controller = MatrixController(cfg)
+    if args.trace is not None:
+        _start_tracing(args.trace)
+    with _phase('config'):
+        validate_args(args, parser)
+        try:
+            cfg = CliConfig(args)
+        except Exception as e:
+            parser.error(str(e))
+            exit()
+        controller = MatrixController(cfg)
+
     controller.start()
@@ -0,0 +1,237 @@
+import json
+import socket
+from argparse import ArgumentTypeError
+from typing import Any, Callable, List, TextIO, Dict
+
+from driver import HDMIMatrix, ProtocolError
+from driver.command import CmdBuilder
+from driver.protocol import TCPPacket, EDID, BeepState, ALL_PORTS, PORT_CONNECTED
+from driver.scene import Scene
+from .config import validate_mapping, out_aton, out_ntoa, ALL_NUM, __ALL
+
+_COMMENT = '#'
+# names with double underscore can not be used inside class body
+_ALL_INPUTS = __ALL
+
+
+class BatchCommand(object):
+    """Single line of batch script compiled into packets"""
+    line: int = None
+    text: str = None
+    packets: List[bytes] = None
+
+    _parse: Callable[[List[TCPPacket]], Any] = None
+
+    def __init__(self, line: int, text: str, packets: List[bytes],
+                 parse: Callable[[List[TCPPacket]], Any]):
+        self.line = line
+        self.text = text
+        self.packets = packets
+        self._parse = parse
+
+    def result(self, replies: List[TCPPacket]) -> Any:
+        """:returns JSON-compatible result built from replies to own packets"""
+        return self._parse(replies)
+
+
+class BatchRunner(object):
+    """
+    Runs batch script over single device connection. Every non-empty line
+    is one of commands below, text after '#' is ignored:
+        map O:I [O:I ...]       map outputs to inputs, like 'control -m'
+        scene NAME              apply scene from config, like 'control -s'
+        status                  query port mapping and ports status
+        edid set IN|* VALUE     set EDID of input, value is number or name
+        edid copy OUT IN|*      copy EDID from output to input
+        beep [on|off]           query or set beeper state
+    In pipelined mode commands are sent in chunks, each chunk as one
+    pipelined request, otherwise one by one. Device handles requests in
+    order, so every command sees results of previous ones. One JSON line
+    is printed for every command with either 'result' or 'error' key.
+    If device fails to reply, every command of the chunk gets an error
+    and the rest of the script is still run.
+    """
+    chunk_size: int = 64
+
+    _device: HDMIMatrix = None
+    _numeric: bool = False
+    _scenes: Dict[str, Scene] = None
+    _pipelined: bool = False
+
+    def __init__(self, device: HDMIMatrix, numeric: bool = False,
+                 scenes: Dict[str, Scene] = None, pipelined: bool = False):
+        """:param pipelined: whether pipelining is enabled on device"""
+        self._device = device
+        self._numeric = numeric
+        self._scenes = scenes or {}
+        self._pipelined = pipelined
+
+    def run(self, stream: TextIO, output: TextIO) -> int:
+        """:returns number of failed commands"""
+        # in interactive mode every command is sent as soon as it is entered,
+        # in serial mode chunks save nothing but widen effect of failure
+        chunk_size = self.chunk_size \
+            if self._pipelined and not stream.isatty() else 1
+        chunk, failed = [], 0
+        for number, line in enumerate(stream, 1):
+            text = line.split(_COMMENT, 1)[0].strip()
+            if not text:
+                continue
+            try:
+                command = self.compile(number, text)
+            except (ValueError, ArgumentTypeError) as e:
+                failed += self._flush(chunk, output)
+                chunk = []
+                self._emit(output, number, text, error=str(e))
+                failed += 1
+                continue
+            chunk.append(command)
+            if len(chunk) >= chunk_size:
+                failed += self._flush(chunk, output)
+                chunk = []
+        failed += self._flush(chunk, output)
+        return failed
+
+    def compile(self, line: int, text: str) -> BatchCommand:
+        """:raises ValueError if command is unknown or arguments are invalid"""
+        name, *args = text.split()
+        name = name.lower()
+        if name == 'map':
+            return self._compile_map(line, text, args)
+        if name == 'scene' and len(args) == 1:
+            return self._compile_scene(line, text, args[0])
+        if name == 'status' and not args:
+            return self._compile_status(line, text)
+        if name == 'edid' and len(args) == 3:
+            return self._compile_edid(line, text, args)
+        if name == 'beep' and len(args) <= 1:
+            return self._compile_beep(line, text, args)
+        raise ValueError(f"Invalid command: {text}")
+
+    def _compile_map(self, line: int, text: str, args: List[str]) -> BatchCommand:
+        if not args:
+            raise ValueError("No mapping specified")
+        mapping = {}
+        for group in map(validate_mapping, args):
+            self._input(str(group.src))
+            if group.dst == ALL_NUM:
+                for o in range(self._device.num_out):
+                    mapping[o + 1] = group.src
+            else:
+                mapping[self._output(str(group.dst))] = group.src
+        packets = [CmdBuilder.map_port(i, o) for o, i in mapping.items()]
+        return BatchCommand(line, text, packets, self._mapping_parser(mapping))
+
+    def _compile_scene(self, line: int, text: str, name: str) -> BatchCommand:
+        scene = self._scenes.get(name)
+        if scene is None:
+            raise ValueError(f"Unknown scene: {name}")
+        return BatchCommand(line, text, scene.packets, self._mapping_parser(scene.mapping))
+
+    def _mapping_parser(self, mapping: Dict[int, int]) -> Callable[[List[TCPPacket]], dict]:
+        def parse(replies: List[TCPPacket]) -> dict:
+            for out, reply in zip(mapping, replies):
+                if reply.arg2 != out:
+                    raise ProtocolError(f"Invalid response, expected {out}, got {reply.arg2}")
+            return {self._out(o): i for o, i in mapping.items()}
+        return parse
+
+    def _compile_status(self, line: int, text: str) -> BatchCommand:
+        outputs = range(1, self._device.num_out + 1)
+        inputs = range(1, self._device.num_in + 1)
+
+        def parse(replies: List[TCPPacket]) -> dict:
+            mapping = replies[:len(outputs)]
+            in_status = replies[len(outputs):len(outputs) + len(inputs)]
+            out_status = replies[len(outputs) + len(inputs):]
+            return {"mapping": {self._out(r.arg1): r.arg2 for r in mapping},
+                    "inputs": {str(r.arg1): r.arg2 == PORT_CONNECTED for r in in_status},
+                    "outputs": {self._out(r.arg1): r.arg2 == PORT_CONNECTED for r in out_status}}
+
+        packets = [CmdBuilder.query_port(o) for o in outputs] \
+            + [CmdBuilder.input_status(i) for i in inputs] \
+            + [CmdBuilder.output_status(o) for o in outputs]
+        return BatchCommand(line, text, packets, parse)
+
+    def _compile_edid(self, line: int, text: str, args: List[str]) -> BatchCommand:
+        action, arg1, arg2 = args
+        action = action.lower()
+        if action == 'set':
+            in_port, value = self._input(arg1), self._edid(arg2)
+            packet = CmdBuilder.set_edid(in_port, value)
+            result = {"input": arg1, "edid": value}
+        elif action == 'copy':
+            out_port, in_port = self._output(arg1), self._input(arg2)
+            packet = CmdBuilder.copy_edid(out_port, in_port)
+            result = {"output": self._out(out_port), "input": arg2}
+        else:
+            raise ValueError(f"Unknown EDID action: {action}")
+        return BatchCommand(line, text, [packet], lambda replies: result)
+
+    @staticmethod
+    def _compile_beep(line: int, text: str, args: List[str]) -> BatchCommand:
+        if not args:
+            return BatchCommand(line, text, [CmdBuilder.query_beep()],
+                                lambda replies: replies[0].arg2 == BeepState.On)
+        state = args[0].lower()
+        if state not in ('on', 'off'):
+            raise ValueError(f"Invalid beeper state: {args[0]}")
+        return BatchCommand(line, text, [CmdBuilder.set_peep(state == 'on')],
+                            lambda replies: state == 'on')
+
+    def _flush(self, chunk: List[BatchCommand], output: TextIO) -> int:
+        if not chunk:
+            return 0
+        packets = [p for command in chunk for p in command.packets]
+        try:
+            replies = self._device.send_commands(packets)
+        except (socket.error, ValueError, ProtocolError) as e:
+            # replies are lost, results of the whole chunk are unknown
+            error = str(e) or type(e).__name__
+            for command in chunk:
+                self._emit(output, command.line, command.text, error=error)
+            return len(chunk)
+        failed, offset = 0, 0
+        for command in chunk:
+            count = len(command.packets)
+            try:
+                result = command.result(replies[offset:offset + count])
+                self._emit(output, command.line, command.text, result=result)
+            except ProtocolError as e:
+                self._emit(output, command.line, command.text, error=str(e))
+                failed += 1
+            offset += count
+        return failed
+
+    @staticmethod
+    def _emit(output: TextIO, line: int, text: str, **kwargs) -> None:
+        res = {"line": line, "command": text}
+        res.update(kwargs)
+        output.write(json.dumps(res) + '\n')
+        output.flush()
+
+    def _out(self, out_port: int) -> str:
+        return str(out_port) if self._numeric else out_ntoa(out_port)
+
+    def _output(self, value: str) -> int:
+        port = out_aton(value.upper()) if value.isalpha() else int(value)
+        if not 1 <= port <= self._device.num_out:
+            raise ValueError(f"Invalid output: {value}")
+        return port
+
+    def _input(self, value: str) -> int:
+        if value == _ALL_INPUTS:
+            return ALL_PORTS
+        port = int(value)
+        if not 1 <= port <= self._device.num_in:
+            raise ValueError(f"Invalid input: {value}")
+        return port
+
+    @staticmethod
+    def _edid(value: str) -> int:
+        if value.isdigit():
+            return int(value)
+        try:
+            return getattr(EDID, value.upper())
+        except AttributeError:
+            raise ValueError(f"Unknown EDID value: {value}") from None
@@ -0,0 +1,62 @@
+import os
+import socket
+
+_SOCKET_NAME = 'drhd.sock'
+
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir is None:
+        import tempfile
+        runtime_dir = tempfile.gettempdir()
+    return os.path.join(runtime_dir, _SOCKET_NAME)
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonClient(object):
+    """
+    Sends requests to running daemon. Every request and reply is single
+    line of JSON, reply contains either 'result' or 'error' key.
+    """
+    path: str = None
+    timeout: float = None
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+
+    def available(self) -> bool:
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.path):
+            return False
+        try:
+            with self._connect():
+                return True
+        except socket.error:
+            return False
+
+    def request(self, command: str, **kwargs) -> any:
+        import json
+        kwargs['command'] = command
+        with self._connect() as sock:
+            sock.sendall(json.dumps(kwargs).encode() + b'\n')
+            with sock.makefile('rb') as stream:
+                reply = stream.readline()
+        if not reply:
+            raise DaemonError("Daemon closed connection without reply")
+        reply = json.loads(reply)
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply['result']
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-import json
 import re
 from argparse import Namespace, ArgumentTypeError, ArgumentParser
 from collections import namedtuple
 from enum import Enum
-from ipaddress import IPv4Address
-from typing import Callable, List
+from ipaddress import IPv4Address, IPv4Network
+from typing import Callable, List, Dict, TextIO, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from driver.netif import Interface
+    from driver.scene import Scene
 
 
 __mapping = namedtuple('mapping', ['src', 'dst'])
@@ -14,6 +17,7 @@ __mapping = namedtuple('mapping', ['src', 'dst'])
 __ALL = '*'
 __FIRST_OUT = 'A'
 ALL_NUM = -1
+ALL_INTERFACES = 'all'
 
 
 def out_aton(symbol: str) -> int:
@@ -31,6 +35,21 @@ def validate_mac(value: str) -> str:
     return value.replace('-', ':')
 
 
+def validate_network(value: str) -> IPv4Network:
+    try:
+        return IPv4Network(value, strict=False)
+    except ValueError as e:
+        raise ArgumentTypeError(f'Invalid network: {value}') from e
+
+
+def validate_address(value: str) -> Tuple[str, int]:
+    """:returns (host, port) from '[HOST:]PORT', host defaults to localhost"""
+    host, _, port = value.rpartition(':')
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ArgumentTypeError(f'Invalid address: {value}')
+    return host or '127.0.0.1', int(port)
+
+
 def validate_mapping(value: str) -> __mapping:
     value = value.upper()
     if not re.match(f"^([A-Z{__ALL}]|[0-9]{{1,2}}):[0-9]{{1,2}}$", value):
@@ -43,8 +62,26 @@ def validate_mapping(value: str) -> __mapping:
     return __mapping(int(src), int(dst))
 
 
+def validate_scenes(data: dict) -> Dict[str, Scene]:
+    """:returns scenes compiled from config, where every scene is list
+                of mapping groups in the same format as --map option"""
+    from driver import HDMIMatrix
+    from driver.scene import Scene
+    scenes = {}
+    for name, groups in data.items():
+        mapping = {}
+        for group in map(validate_mapping, groups):
+            if group.dst == ALL_NUM:
+                for o in range(HDMIMatrix.num_out):
+                    mapping[o + 1] = group.src
+            else:
+                mapping[group.dst] = group.src
+        scenes[name] = Scene(name, mapping)
+    return scenes
+
+
 def validate_args(args: Namespace, parser: ArgumentParser) -> None:
-    if 'map' not in args:
+    if not getattr(args, 'map', None):
         return
 
     outputs = []
@@ -63,6 +100,9 @@ class Command(Enum):
     Scan = "scan"
     Status = "status"
     Control = "control"
+    Daemon = "daemon"
+    Batch = "batch"
+    Watch = "watch"
 
 
 class CliConfig(object):
@@ -73,6 +113,24 @@ class CliConfig(object):
     bind_to: IPv4Address = None
     device: IPv4Address = None
     device_mac: str = None
+    pipeline: bool = None
+    socket: str = None
+    no_daemon: bool = None
+    cache_ttl: float = None
+    expect: int = None
+    sweep: List[IPv4Network] = None
+    rate: float = None
+    interface: List[str] = None
+    interfaces: List[Interface] = None
+    file: TextIO = None
+    scene: str = None
+    scenes: Dict[str, Scene] = None
+    min_interval: float = None
+    max_interval: float = None
+    metrics: Tuple[str, int] = None
+    timeout: float = None
+    trace: str = None
+    capture: str = None
     numeric: bool = None
     json: bool = None
     map: List[__mapping] = None
@@ -86,14 +144,33 @@ class CliConfig(object):
 
         if 'config' in args and args['config'] is not None:
             self._read_config(args['config'])
+        self._resolve_interfaces()
+        if self.scene is not None and self.scene not in (self.scenes or {}):
+            raise ValueError(f"Unknown scene: {self.scene}")
 
     def _read_config(self, data) -> None:
+        import json
         data = json.load(data)
         self._fill_from(data)
         self._check_ip(data, 'bind_to')
         self._check_ip(data, 'device')
         if 'device_mac' in data:
             self.device_mac = validate_mac(data['device_mac'])
+        if 'sweep' in data:
+            self.sweep = [validate_network(n) for n in data['sweep']]
+        if 'scenes' in data:
+            self.scenes = validate_scenes(data['scenes'])
+
+    def _resolve_interfaces(self) -> None:
+        if not self.interface:
+            return
+        from driver.netif import list_interfaces, find_interfaces
+        if ALL_INTERFACES in self.interface:
+            self.interfaces = list_interfaces()
+            if not self.interfaces:
+                raise ValueError("Unable to enumerate network interfaces")
+        else:
+            self.interfaces = find_interfaces(self.interface)
 
     def _check_ip(self, data: dict, key: str) -> None:
         if key not in data:
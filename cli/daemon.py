@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import socketserver
+import time
+from ipaddress import IPv4Address, IPv4Network
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from driver import HDMIMatrix
+from driver.capture import Capture
+from driver.discovery import NetworkExplorer
+from driver.metrics import Metrics, MetricsServer
+from driver.netif import Interface
+from driver.pool import MatrixPool
+from driver.protocol import UDPPacket, TCP_PORT
+from driver.scene import Scene
+from driver.utils import SupportsLogging
+from .client import DaemonClient, DaemonError
+from .devices import device_to_dict
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: '_DaemonServer'
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = {"result": self.server.daemon.execute(request)}
+            except Exception as e:
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class _DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    daemon: 'MatrixDaemon' = None
+
+
+class MatrixDaemon(SupportsLogging):
+    """
+    Resident process which keeps discovered devices and warm connections
+    to them and serves CLI requests over Unix domain socket.
+    """
+    _tag = 'daemon'
+
+    scan_ttl: float = 60.0
+
+    _path: str = None
+    _bind_to: str = None
+    _num_req: int = None
+    _log_udp: str = None
+    _log_tcp: str = None
+    _pipeline: bool = False
+    _sweep: List[IPv4Network] = None
+    _rate: float = None
+    _interfaces: List[Interface] = None
+    _metrics_address: Tuple[str, int] = None
+    _capture: Capture = None
+    _timeout: float = None
+
+    _metrics: Metrics = None
+    _pool: MatrixPool = None
+    _devices: Dict[str, UDPPacket] = None
+    _scenes: Dict[str, Scene] = None
+    _scanned_at: float = None
+    _scan_lock: Lock = None
+    _server: _DaemonServer = None
+
+    def __init__(self, path: str, bind_to: str = '0.0.0.0', num_req: int = 3,
+                 log_udp: str = 'warning', log_tcp: str = 'warning',
+                 pipeline: bool = False, sweep: List[IPv4Network] = None,
+                 rate: float = None, interfaces: List[Interface] = None,
+                 metrics: Tuple[str, int] = None, capture: Capture = None,
+                 timeout: float = None):
+        """
+        :param metrics: address to serve OpenMetrics at, None disables metrics
+        :param capture: records traffic of all devices and scans if given
+        :param timeout: request timeout of devices, see HDMIMatrix.timeouts
+        """
+        super().__init__(logging.WARNING)
+        self._path = path
+        self._bind_to = bind_to
+        self._num_req = num_req
+        self._log_udp = log_udp
+        self._log_tcp = log_tcp
+        self._pipeline = pipeline
+        self._sweep = sweep
+        self._rate = rate
+        self._interfaces = interfaces
+        self._metrics_address = metrics
+        self._capture = capture
+        self._timeout = timeout
+        if metrics is not None:
+            self._metrics = Metrics()
+        self._pool = MatrixPool(factory=self._create_device)
+        self._devices = {}
+        self._scenes = {}
+        self._scan_lock = Lock()
+
+    def serve(self) -> None:
+        if os.path.exists(self._path):
+            if DaemonClient(self._path).available():
+                raise DaemonError(f"Daemon is already running at: {self._path}")
+            os.unlink(self._path)
+
+        self._server = _DaemonServer(self._path, _RequestHandler)
+        self._server.daemon = self
+        os.chmod(self._path, 0o600)
+        self._logger.info(f"Listening at: {self._path}")
+        metrics_server = None
+        if self._metrics is not None:
+            metrics_server = MetricsServer(self._metrics)
+            metrics_server.start(self._metrics_address)
+        try:
+            self._scan()
+            self._server.serve_forever()
+        finally:
+            if metrics_server is not None:
+                metrics_server.stop()
+            self._server.server_close()
+            self._pool.close()
+            os.unlink(self._path)
+            self._logger.info("Stopped")
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+
+    def execute(self, request: dict) -> any:
+        command = request.get('command')
+        self._logger.info(f"Request: {request}")
+        if command == 'scan':
+            devices = self._scan(max_age=0 if request.get('refresh') else self.scan_ttl)
+            return [device_to_dict(d) for d in devices]
+
+        addr = self._resolve(request.get('device'), request.get('device_mac'))
+        with self._pool.acquire((addr, TCP_PORT)) as device:
+            if command == 'status':
+                return {"mapping": device.get_port_mapping(),
+                        "inputs": device.get_inputs_status(),
+                        "outputs": device.get_outputs_status()}
+            if command == 'control':
+                mapping = {int(o): i for o, i in request['mapping'].items()}
+                return device.apply_mapping(mapping)
+            if command == 'scene':
+                device.recall(self._scene(request['name'], request['mapping']))
+                return None
+        raise ValueError(f"Unknown command: {command}")
+
+    def _scene(self, name: str, mapping: Dict[str, int]) -> Scene:
+        """:returns scene compiled on first request, recompiled if changed"""
+        mapping = {int(o): i for o, i in mapping.items()}
+        scene = self._scenes.get(name)
+        if scene is None or scene.mapping != mapping:
+            scene = self._scenes[name] = Scene(name, mapping)
+        return scene
+
+    def _resolve(self, ip: Optional[str], mac: Optional[str]) -> IPv4Address:
+        if ip is not None:
+            return IPv4Address(ip)
+        for max_age in (self.scan_ttl, 0):
+            devices = self._scan(max_age)
+            for device in devices:
+                if mac is None or device.mac == mac.lower():
+                    return device.devIP
+        raise LookupError(f"Device not found: {mac or 'any'}")
+
+    def _scan(self, max_age: float = 0) -> List[UDPPacket]:
+        """:returns known devices, rescans network if they are older than max_age"""
+        with self._scan_lock:
+            if self._scanned_at is not None \
+                    and time.monotonic() - self._scanned_at < max_age:
+                return list(self._devices.values())
+
+            devices = {}
+            explorer = NetworkExplorer(lambda d: devices.setdefault(d.mac, d))
+            explorer.logging(self._log_udp)
+            explorer.retry_count(self._num_req)
+            explorer.metrics(self._metrics)
+            explorer.capture(self._capture)
+            explorer.sweep(self._sweep, self._rate)
+            explorer.start(self._bind_to, self._interfaces)
+            explorer.join()
+            self._devices = devices
+            self._scanned_at = time.monotonic()
+            self._logger.info(f"Found {len(devices)} devices")
+            return list(devices.values())
+
+    def _create_device(self, endpoint) -> HDMIMatrix:
+        device = HDMIMatrix(endpoint)
+        device.logging(self._log_tcp)
+        device.pipelining(self._pipeline)
+        device.metrics(self._metrics)
+        device.capture(self._capture)
+        device.timeouts(request=self._timeout)
+        # one unresponsive device must not hold up requests of others
+        device.circuit_breaker(True)
+        return device
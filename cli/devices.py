@@ -0,0 +1,71 @@
+import json
+import os
+import time
+from typing import Dict, Optional
+
+from driver.protocol import UDPPacket
+
+_CACHE_NAME = 'devices.json'
+
+
+def default_cache_path() -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'drhd', _CACHE_NAME)
+
+
+def device_to_dict(data: UDPPacket) -> dict:
+    return {"mac": data.mac,
+            "ip": str(data.devIP),
+            "gateway": str(data.gwIP),
+            "netmask": str(data.netMask),
+            "port": data.devPort}
+
+
+def device_from_dict(data: dict) -> UDPPacket:
+    return UDPPacket.build(data['mac'], data['ip'], data['gateway'],
+                           data['netmask'], data['port'])
+
+
+class DeviceCache(object):
+    """
+    Persistent storage of discovery results keyed by device MAC address,
+    entries older than TTL (in seconds) are treated as missing.
+    """
+    path: str = None
+    ttl: float = None
+
+    _entries: Dict[str, dict] = None
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as file:
+                self._entries = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_path, self.path)
+
+    def get(self, mac: str) -> Optional[UDPPacket]:
+        entry = self._entries.get(mac.lower())
+        if entry is None or time.time() - entry['seen'] > self.ttl:
+            return None
+        return device_from_dict(entry)
+
+    def put(self, data: UDPPacket) -> None:
+        entry = device_to_dict(data)
+        entry['seen'] = time.time()
+        self._entries[data.mac.lower()] = entry
+
+    def remove(self, mac: str) -> None:
+        self._entries.pop(mac.lower(), None)
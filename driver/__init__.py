@@ -1,13 +1,25 @@
 import logging
 import socket
+from collections import deque
+from contextlib import contextmanager
 from enum import Enum
 from ipaddress import IPv4Address
 from threading import Event
-from typing import Tuple, Dict
+from time import monotonic
+from typing import Tuple, Dict, List, Iterable, Any, Callable, Optional
 
 from .binutils import hexify
+from .breaker import CircuitBreaker, CircuitOpenError, breaker_for
+from .cache import StateCache, MAPPING, INPUT, OUTPUT
+from .capture import Capture, SENT, RECEIVED, TCP
 from .command import CmdBuilder
-from .protocol import TCP_PACKET_LEN, PORT_CONNECTED, TCPPacket
+from .metrics import Metrics, CRC_ERRORS, PROTOCOL_ERRORS, RECONNECTS, \
+    RETRIES, CIRCUIT_REJECTIONS
+from .protocol import TCP_PACKET_LEN, PORT_CONNECTED, TCPPacket, BeepState, \
+    Command, Action, _TCP_HEADER
+from .scene import Scene
+from .tracing import span
+from .transport import Transport, TCPTransport
 from .utils import SupportsLogging
 
 
@@ -20,6 +32,16 @@ class PortType(Enum):
     Output = "output"
 
 
+# queries which may be safely repeated, (command, action)
+_IDEMPOTENT = {(Command.Port, Action.Port.Query),
+               (Command.Status, Action.Status.Input),
+               (Command.Status, Action.Status.Output),
+               (Command.Status, Action.Status.Beeper)}
+# max number of stale replies to earlier timed out requests and
+# corrupt frames skipped while waiting for reply to request
+_MAX_STALE_REPLIES = 8
+
+
 class HDMIMatrix(SupportsLogging):
     _tag = 'matrix'
 
@@ -29,35 +51,184 @@ class HDMIMatrix(SupportsLogging):
     endpoint: Tuple[str, int] = None
 
     _connected: Event = None
-    _socket: socket = None
+    _transport: Transport = None
+    _has_connected: bool = False
+    _pipelining: bool = False
+    _pipeline_timeout: float = 1.0
+    _cache: StateCache = None
+    _metrics: Metrics = None
+    _sent_at: float = 0.0
+    _capture: Capture = None
+    _transport_timeout: Optional[float] = None
+
+    _connect_timeout: float = 5.0
+    _request_timeout: float = 5.0
+    _operation_timeout: float = None
+    _retry_count: int = 2
+    _breaker: CircuitBreaker = None
+    _deadline: float = None
+    _depth: int = 0
+
+    _buffer_size: int = 1024
     _buffer: bytearray = None
+    _view: memoryview = None
+    _head: int = 0
+    _tail: int = 0
 
     def __init__(self, endpoint: Tuple[IPv4Address, int]):
         super().__init__(logging.WARNING)
         self.endpoint = (str(endpoint[0]), endpoint[1])
         self._connected = Event()
-        self._buffer = bytearray()
+        self._buffer = bytearray(self._buffer_size)
+        self._view = memoryview(self._buffer)
+        self._transport = TCPTransport(self.endpoint)
 
-    def connect(self) -> None:
+    def connect(self, timeout: float = None) -> None:
+        """:param timeout: connection timeout in seconds, None means default
+                        connect timeout (see timeouts)"""
         self._logger.info(f"Connecting to: {self.endpoint}")
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect(self.endpoint)
+        # accepted connection does not prove that device replies, so
+        # trial of half-open circuit is left to the first operation
+        self._check_breaker(trial=False)
+        if self._has_connected and self._metrics is not None:
+            self._metrics.inc(RECONNECTS)
+        self._has_connected = True
+        self._head = self._tail = 0
+        self.invalidate()
+        self._transport.close()
+        self._transport_timeout = self._connect_timeout if timeout is None else timeout
+        try:
+            with span('connect', self._tag, endpoint=self.endpoint[0]):
+                self._transport.connect(self._transport_timeout)
+        except socket.error:
+            if self._breaker is not None:
+                self._breaker.failure()
+            raise
         self._connected.set()
         self._logger.info(f"Connected to: {self.endpoint}")
 
     def disconnect(self) -> None:
         self._check_connection()
         self._logger.info(f"Disconnecting from: {self.endpoint}")
-        self._socket.close()
+        self._transport.close()
         self._connected.clear()
         self._logger.info("Disconnected")
 
-    def get_source_for(self, out_port: int) -> int:
+    def is_connected(self) -> bool:
+        return self._connected.is_set()
+
+    def ping(self, timeout: float = None) -> None:
+        """
+        Sends cheap query to check if connection is still alive.
+        :raises socket.error if device does not reply within timeout
+                (in seconds) or connection is closed
+        """
         self._check_connection()
-        self._send_packet(CmdBuilder.query_port(out_port))
-        reply = self._read_packet()
-        self._logger.info(f"Port mapping: {reply.arg1} -> {reply.arg2}")
-        return reply.arg1
+        with self._operation(timeout):
+            reply = self._request(CmdBuilder.query_beep())
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"Ping reply: {reply}")
+
+    def pipelining(self, state: bool, timeout: float = None) -> None:
+        """
+        Enables or disables pipelined mode, in this mode bulk queries
+        sends all requests at once and then reads all replies. If device
+        does not reply within timeout (in seconds) or replies with
+        unexpected packets, requests without reply are resent one by one,
+        pipelined mode stays enabled for next requests.
+        """
+        self._pipelining = state
+        if timeout is not None:
+            self._pipeline_timeout = timeout
+
+    def timeouts(self, connect: float = None, request: float = None,
+                 operation: float = None) -> None:
+        """
+        Sets timeouts in seconds, None keeps current value.
+        :param connect: default timeout of connect()
+        :param request: max time of every single send or receive call
+        :param operation: deadline of whole public call, including all
+                          its requests and retries, disabled by default
+        """
+        if connect is not None:
+            self._connect_timeout = connect
+        if request is not None:
+            self._request_timeout = request
+        if operation is not None:
+            self._operation_timeout = operation
+
+    def retry_count(self, count: int) -> None:
+        """
+        Sets how many times query (port mapping, port status, beeper state)
+        is repeated after timeout or corrupt reply, commands which change
+        device state are never repeated
+        """
+        self._retry_count = max(count, 0)
+
+    def circuit_breaker(self, state: bool, threshold: int = 5,
+                        reset_timeout: float = 30.0) -> None:
+        """
+        Enables or disables circuit breaker shared by all connections to
+        the same endpoint (see breaker.CircuitBreaker). After threshold
+        consecutive failed calls every call fails immediately with
+        CircuitOpenError for reset_timeout seconds.
+        """
+        self._breaker = breaker_for(self.endpoint, threshold, reset_timeout) \
+            if state else None
+
+    def caching(self, state: bool, mapping_ttl: float = 1.0,
+                status_ttl: float = 1.0) -> None:
+        """
+        Enables or disables state cache, when enabled port mapping and port
+        status are returned from cache until their TTL (in seconds) expires,
+        TTL of None means that cached values never expire. Cached mapping is
+        updated when device acknowledges mapping change.
+        """
+        self._cache = StateCache(mapping_ttl, status_ttl) if state else None
+
+    def metrics(self, registry: Metrics = None) -> None:
+        """
+        Enables collection of command round trip times and error counters
+        into given registry, None disables collection.
+        """
+        self._metrics = registry
+
+    def capture(self, capture: Capture = None) -> None:
+        """Enables recording of every sent and received packet, None disables it"""
+        self._capture = capture
+
+    def transport(self, transport: Transport) -> None:
+        """
+        Replaces byte transport used on next connect, default one is
+        TCPTransport to device endpoint. LoopbackTransport runs driver
+        against simulated device without sockets.
+        """
+        if self.is_connected():
+            self._transport.close()
+            self._connected.clear()
+        self._transport = transport
+
+    def socket_factory(self, factory: Callable[..., socket.socket]) -> None:
+        """
+        Replaces function which creates socket on connect, it is called
+        with the same arguments as socket.socket. Used to run driver
+        against recorded traffic (see replay.Replayer.socket).
+        """
+        self.transport(TCPTransport(self.endpoint, factory))
+
+    def invalidate(self, field: str = None) -> None:
+        """
+        Drops cached state, field is one of 'mapping', 'input', 'output'
+        or None to drop all cached values.
+        """
+        if self._cache is not None:
+            self._cache.invalidate(field)
+
+    def get_source_for(self, out_port: int) -> int:
+        source = self._get_mapping([out_port])[out_port]
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Port mapping: {out_port} -> {source}")
+        return source
 
     def get_input_status(self, in_port: int) -> bool:
         """:returns True if port is connected, otherwise false"""
@@ -68,15 +239,7 @@ class HDMIMatrix(SupportsLogging):
         return self.get_port_status(out_port, PortType.Output)
 
     def get_port_status(self, port: int, _type: PortType) -> bool:
-        self._check_connection()
-        cmd = CmdBuilder.input_status if _type is PortType.Input \
-            else CmdBuilder.output_status
-        self._send_packet(cmd(port))
-        reply = self._read_packet()
-        connected = reply.arg2 == PORT_CONNECTED
-        status = "connected" if connected else "not connected"
-        self._logger.info(f"{_type.value.capitalize()} {reply.arg1} is {status}")
-        return connected
+        return self._get_status([port], _type)[port]
 
     def get_inputs_status(self) -> Dict[int, bool]:
         return self.get_ports_status(PortType.Input)
@@ -86,10 +249,7 @@ class HDMIMatrix(SupportsLogging):
 
     def get_ports_status(self, _type: PortType) -> Dict[int, bool]:
         count = self.num_in if _type is PortType.Input else self.num_out
-        res = {}
-        for i in range(count):
-            res[i + 1] = self.get_port_status(i + 1, _type)
-        return res
+        return self._get_status(range(1, count + 1), _type)
 
     def get_port_mapping(self) -> Dict[int, int]:
         """
@@ -97,40 +257,416 @@ class HDMIMatrix(SupportsLogging):
                  where keys represents output numbers (starting from 1) and
                  values represents corresponding input numbers.
         """
-        self._check_connection()
-        mapping = {}
-        for i in range(self.num_out):
-            self._send_packet(CmdBuilder.query_port(i + 1))
-            reply = self._read_packet()
-            mapping[reply.arg1] = reply.arg2
-        self._logger.info(f"Port mapping: {mapping}")
+        mapping = self._get_mapping(range(1, self.num_out + 1))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Port mapping: {mapping}")
         return mapping
 
+    def get_state(self) -> Dict[str, Dict[int, Any]]:
+        """
+        Reads port mapping and status of all ports from device with single
+        bulk request, bypassing cache.
+        :returns dictionary with 'mapping', 'input' and 'output' keys, see
+                 get_port_mapping and get_ports_status for values format
+        """
+        self._check_connection()
+        outputs = range(1, self.num_out + 1)
+        inputs = range(1, self.num_in + 1)
+        packets = [CmdBuilder.query_port(o) for o in outputs] \
+            + [CmdBuilder.input_status(i) for i in inputs] \
+            + [CmdBuilder.output_status(o) for o in outputs]
+        replies = iter(self._request_all(packets))
+
+        state = {MAPPING: {}, INPUT: {}, OUTPUT: {}}
+        for field, ports in ((MAPPING, outputs), (INPUT, inputs), (OUTPUT, outputs)):
+            for port, reply in zip(ports, replies):
+                if field == MAPPING:
+                    value = reply.arg2
+                else:
+                    value = self._parse_status(reply, PortType(field))
+                state[field][port] = value
+                self._store(field, port, value)
+        return state
+
     def map_port(self, in_port: int, out_port: int):
-        self._send_packet(CmdBuilder.map_port(in_port, out_port))
-        reply = self._read_packet()
+        reply = self._request(CmdBuilder.map_port(in_port, out_port))
         if reply.arg2 != out_port:
-            raise ProtocolError(f"Invalid response, expected {out_port}, got {reply.arg2}")
-        self._logger.info(f"Set port mapping: {in_port} -> {out_port}")
+            raise self._protocol_error(f"Invalid response, expected {out_port}, got {reply.arg2}")
+        self._store(MAPPING, out_port, in_port)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Set port mapping: {in_port} -> {out_port}")
+
+    def map_all(self, in_port: int) -> Dict[int, int]:
+        """See apply_mapping"""
+        return self.apply_mapping({i + 1: in_port for i in range(self.num_out)})
+
+    def apply_mapping(self, mapping: Dict[int, int],
+                      current: Dict[int, int] = None) -> Dict[int, int]:
+        """
+        Maps outputs to inputs sending commands only for outputs which
+        are not mapped to requested inputs yet. Current mapping is read
+        from device (or cache, if enabled) unless specified explicitly.
+        In pipelined mode reading takes one round trip and all commands
+        are sent with one more write.
+        :param mapping: dictionary where keys represents output numbers
+                        and values represents corresponding input numbers
+        :returns dictionary with changed outputs only, in the same format
+        """
+        self._check_connection()
+        if current is None:
+            current = self._get_mapping(mapping.keys())
+        changes = {o: i for o, i in mapping.items() if current.get(o) != i}
+        packets = [CmdBuilder.map_port(i, o) for o, i in changes.items()]
+        replies = self._request_all(packets)
+        for (out, _in), reply in zip(changes.items(), replies):
+            if reply.arg2 != out:
+                raise self._protocol_error(f"Invalid response, expected {out}, got {reply.arg2}")
+            self._store(MAPPING, out, _in)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Mapping changes: {changes}")
+        return changes
+
+    def recall(self, scene: Scene) -> None:
+        """
+        Applies precompiled scene with single write and bulk read of
+        replies regardless of pipelining setting, if device fails to
+        handle it, commands are resent one by one.
+        """
+        self._check_connection()
+        replies = self._request_all(scene.packets, scene.data, pipelined=True)
+        for (out, _in), reply in zip(scene.mapping.items(), replies):
+            if reply.arg2 != out:
+                raise self._protocol_error(f"Invalid response, expected {out}, got {reply.arg2}")
+            self._store(MAPPING, out, _in)
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Scene recalled: {scene}")
+
+    def set_edid(self, in_port: int, value: int) -> None:
+        """:param value: one of protocol.EDID values, in_port may be ALL_PORTS"""
+        self._check_connection()
+        self._request(CmdBuilder.set_edid(in_port, value))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Set EDID of input {in_port} to {value}")
+
+    def copy_edid(self, out_port: int, in_port: int) -> None:
+        """Copies EDID of display connected to output to input, in_port may be ALL_PORTS"""
+        self._check_connection()
+        self._request(CmdBuilder.copy_edid(out_port, in_port))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Copied EDID from output {out_port} to input {in_port}")
+
+    def get_beeper(self) -> bool:
+        """:returns True if beeper is enabled"""
+        self._check_connection()
+        reply = self._request(CmdBuilder.query_beep())
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Beeper state: {reply.arg2:#04x}")
+        return reply.arg2 == BeepState.On
+
+    def set_beeper(self, state: bool) -> None:
+        self._check_connection()
+        self._request(CmdBuilder.set_peep(state))
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Set beeper state: {state}")
 
-    def map_all(self, in_port: int):
-        for i in range(self.num_out):
-            self.map_port(in_port, i + 1)
+    def send_commands(self, packets: List[bytes]) -> List[TCPPacket]:
+        """
+        Sends prepared packets (see CmdBuilder), in pipelined mode all of
+        them at once. Cached state is dropped since commands may change it.
+        :returns replies in order of packets
+        """
+        self._check_connection()
+        self.invalidate()
+        return self._request_all(packets)
 
     def _check_connection(self) -> None:
         if not self._connected.is_set():
             raise socket.error("Not connected!")
 
-    def _send_packet(self, data: TCPPacket) -> None:
-        data = bytes(data)
-        self._logger.debug(f"SEND >> {hexify(data)}")
-        self._socket.send(data)
-
-    def _read_packet(self) -> TCPPacket:
-        while len(self._buffer) < TCP_PACKET_LEN:
-            data = self._socket.recv(1024)
-            self._buffer += data
-        data = self._buffer[:TCP_PACKET_LEN]
-        self._buffer = self._buffer[TCP_PACKET_LEN:]
-        self._logger.debug(f"RECV << {hexify(data)}")
-        return TCPPacket(data)
+    def _get_mapping(self, outputs: Iterable[int]) -> Dict[int, int]:
+        self._check_connection()
+        outputs = list(outputs)
+        res = self._cached(MAPPING, outputs)
+        missing = [o for o in outputs if o not in res]
+        if missing:
+            packets = [CmdBuilder.query_port(o) for o in missing]
+            for out, reply in zip(missing, self._request_all(packets)):
+                res[out] = reply.arg2
+                self._store(MAPPING, out, reply.arg2)
+        return {o: res[o] for o in outputs}
+
+    def _get_status(self, ports: Iterable[int], _type: PortType) -> Dict[int, bool]:
+        self._check_connection()
+        ports = list(ports)
+        res = self._cached(_type.value, ports)
+        missing = [p for p in ports if p not in res]
+        if missing:
+            cmd = CmdBuilder.input_status if _type is PortType.Input \
+                else CmdBuilder.output_status
+            for port, reply in zip(missing, self._request_all([cmd(p) for p in missing])):
+                res[port] = self._parse_status(reply, _type)
+                self._store(_type.value, port, res[port])
+        return {p: res[p] for p in ports}
+
+    def _cached(self, field: str, ports: Iterable[int]) -> Dict[int, Any]:
+        if self._cache is None:
+            return {}
+        return self._cache.get_all(field, ports)
+
+    def _store(self, field: str, port: int, value: Any) -> None:
+        if self._cache is not None:
+            self._cache.put(field, port, value)
+
+    def _parse_status(self, reply: TCPPacket, _type: PortType) -> bool:
+        connected = reply.arg2 == PORT_CONNECTED
+        if self._logger.isEnabledFor(logging.INFO):
+            status = "connected" if connected else "not connected"
+            self._logger.info(f"{_type.value.capitalize()} {reply.arg1} is {status}")
+        return connected
+
+    def _request(self, packet: bytes) -> TCPPacket:
+        idempotent = (packet[2], packet[3]) in _IDEMPOTENT
+        attempts = 1 + self._retry_count if idempotent else 1
+        with self._operation():
+            for attempt in range(attempts):
+                try:
+                    with span('request', self._tag, packet=packet, attempt=attempt):
+                        self._send_packet(packet)
+                        return self._read_reply(packet)
+                except (socket.timeout, ValueError, ProtocolError) as e:
+                    if attempt + 1 == attempts or self._expired():
+                        raise
+                    self._logger.warning(f"Request failed ({e}), retrying")
+                    if self._metrics is not None:
+                        self._metrics.inc(RETRIES)
+
+    def _read_reply(self, packet: bytes) -> TCPPacket:
+        """
+        Reads reply to given request skipping late replies to previous
+        requests, which may arrive after their request has timed out, and
+        corrupt frames followed by more data, which may be the reply
+        :raises ValueError if the last received frame is corrupt
+        """
+        key = TCPPacket.key_of(packet)
+        for _ in range(_MAX_STALE_REPLIES):
+            try:
+                reply = self._read_packet()
+            except ValueError as e:
+                # the search for header is resumed right after header of
+                # corrupt frame, so there is more data if anything follows it
+                if self._tail - self._head <= TCP_PACKET_LEN - len(_TCP_HEADER):
+                    raise
+                self._logger.warning(f"Corrupt reply skipped: {e}")
+                continue
+            if reply.key() == key:
+                return reply
+            if self._logger.isEnabledFor(logging.INFO):
+                self._logger.info(f"Stale reply skipped: {reply}")
+        raise self._protocol_error(f"No reply to {hexify(packet)}")
+
+    def _request_all(self, packets: List[bytes], data: bytes = None,
+                     pipelined: bool = None) -> List[TCPPacket]:
+        """
+        :param data: packets already concatenated, if available
+        :param pipelined: overrides pipelining setting for this request
+        :returns replies for given requests in order of requests, in
+                 pipelined mode replies are matched to requests by
+                 command, action and argument (see TCPPacket.key)
+        """
+        if pipelined is None:
+            pipelined = self._pipelining
+        with self._operation():
+            if not pipelined or len(packets) < 2:
+                return [self._request(p) for p in packets]
+            replies = self._request_pipelined(packets, data)
+            for i, packet in enumerate(packets):
+                if replies[i] is None:
+                    replies[i] = self._request(packet)
+            return replies
+
+    def _request_pipelined(self, packets: List[bytes],
+                           data: bytes = None) -> List[Optional[TCPPacket]]:
+        """:returns replies, None for requests without reply if request failed"""
+        pending = {}
+        for i, packet in enumerate(packets):
+            pending.setdefault(TCPPacket.key_of(packet), deque()).append(i)
+        replies = [None] * len(packets)
+
+        if data is None:
+            data = b''.join(packets)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"SEND >> {hexify(data)}")
+        try:
+            with span('pipeline', self._tag, count=len(packets)):
+                if self._capture is not None:
+                    self._capture.record(SENT, TCP, self.endpoint, data)
+                self._set_timeout(self._timeout())
+                self._sent_at = monotonic()
+                self._transport.sendall(data)
+                for _ in range(len(packets)):
+                    reply = self._read_packet(self._pipeline_timeout)
+                    indices = pending.get(reply.key())
+                    if not indices:
+                        raise self._protocol_error(f"Unexpected reply: {reply}")
+                    replies[indices.popleft()] = reply
+        except (socket.timeout, ProtocolError, ValueError) as e:
+            self._logger.warning(f"Pipelined request failed ({e}), "
+                                 + "resending unanswered requests one by one")
+            self._drain()
+        return replies
+
+    @contextmanager
+    def _operation(self, timeout: float = None):
+        """
+        Scope of single public call, sets its deadline and reports its
+        result to circuit breaker. Nested scopes are part of outer one.
+        :param timeout: overrides operation timeout
+        """
+        if self._depth > 0:
+            yield
+            return
+        self._check_breaker()
+        if timeout is None:
+            timeout = self._operation_timeout
+        self._deadline = None if timeout is None else monotonic() + timeout
+        self._depth += 1
+        try:
+            yield
+        except (socket.error, ValueError, ProtocolError):
+            if self._breaker is not None:
+                self._breaker.failure()
+            raise
+        else:
+            if self._breaker is not None:
+                self._breaker.success()
+        finally:
+            self._depth -= 1
+            self._deadline = None
+
+    def _check_breaker(self, trial: bool = True) -> None:
+        if self._breaker is None:
+            return
+        try:
+            self._breaker.check(trial)
+        except CircuitOpenError:
+            if self._metrics is not None:
+                self._metrics.inc(CIRCUIT_REJECTIONS)
+            raise
+
+    def _expired(self) -> bool:
+        return self._deadline is not None and monotonic() >= self._deadline
+
+    def _timeout(self, timeout: float = None) -> Optional[float]:
+        """
+        :param timeout: overrides request timeout
+        :returns timeout of next socket call limited by operation deadline
+        :raises socket.timeout if deadline has already passed
+        """
+        if timeout is None:
+            timeout = self._request_timeout
+        if self._deadline is not None:
+            left = self._deadline - monotonic()
+            if left <= 0:
+                raise socket.timeout("Operation deadline exceeded")
+            if timeout is None or left < timeout:
+                timeout = left
+        return timeout
+
+    def _set_timeout(self, timeout: Optional[float]) -> None:
+        # settimeout makes system call, so it is skipped if not changed
+        if timeout != self._transport_timeout:
+            self._transport.settimeout(timeout)
+            self._transport_timeout = timeout
+
+    def _drain(self) -> None:
+        """
+        Discards all received data until no data arrives within pipeline
+        timeout or operation deadline passes
+        """
+        try:
+            while True:
+                self._set_timeout(self._timeout(self._pipeline_timeout))
+                if not self._transport.recv_into(self._view):
+                    break
+        except socket.timeout:
+            pass
+        self._head = self._tail = 0
+
+    def _send_packet(self, data: bytes) -> None:
+        # hexify is costly and packets are sent often, so message is
+        # formatted only when it will be actually logged
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"SEND >> {hexify(data)}")
+        if self._capture is not None:
+            self._capture.record(SENT, TCP, self.endpoint, data)
+        self._set_timeout(self._timeout())
+        self._sent_at = monotonic()
+        self._transport.sendall(data)
+
+    def _read_packet(self, timeout: float = None) -> TCPPacket:
+        """:param timeout: overrides request timeout for every receive call"""
+        while True:
+            while self._tail - self._head < TCP_PACKET_LEN:
+                if self._tail == self._buffer_size:
+                    self._compact_buffer()
+                self._set_timeout(self._timeout(timeout))
+                size = self._transport.recv_into(self._view[self._tail:])
+                if size == 0:
+                    raise ConnectionError("Connection closed by peer")
+                self._tail += size
+            if self._buffer.startswith(_TCP_HEADER, self._head):
+                break
+            self._resync()
+
+        start, self._head = self._head, self._head + TCP_PACKET_LEN
+        # packet is parsed in place, view is released right after
+        # parsing because buffer contents will be overwritten later
+        with self._view[start:self._head] as data:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(f"RECV << {hexify(data)}")
+            if self._capture is not None:
+                self._capture.record(RECEIVED, TCP, self.endpoint, data)
+            try:
+                packet = TCPPacket(data)
+            except ValueError:
+                if self._metrics is not None:
+                    self._metrics.inc(CRC_ERRORS)
+                # frame may be cut short and followed by next one,
+                # so search for header starts right after this one
+                self._head = start + len(_TCP_HEADER)
+                raise
+        if self._head == self._tail:
+            self._head = self._tail = 0
+        if self._metrics is not None:
+            # in pipelined mode all requests are sent at once, so each
+            # reply is timed from the moment whole batch was sent
+            self._metrics.observe_rtt(packet.cmd, packet.action,
+                                      monotonic() - self._sent_at)
+        return packet
+
+    def _resync(self) -> None:
+        """Discards received data up to next packet header"""
+        start = self._head
+        pos = self._buffer.find(_TCP_HEADER, self._head, self._tail)
+        if pos >= 0:
+            self._head = pos
+        elif self._buffer[self._tail - 1] == _TCP_HEADER[0]:
+            # the first byte of header may be followed by the rest later
+            self._head = self._tail - 1
+        else:
+            self._head = self._tail
+        self._logger.warning(f"Discarded {self._head - start} bytes "
+                             + "before packet header")
+        if self._head == self._tail:
+            self._head = self._tail = 0
+
+    def _protocol_error(self, message: str) -> ProtocolError:
+        if self._metrics is not None:
+            self._metrics.inc(PROTOCOL_ERRORS)
+        return ProtocolError(message)
+
+    def _compact_buffer(self) -> None:
+        """Moves unread data to the beginning of receive buffer"""
+        size = self._tail - self._head
+        self._buffer[:size] = self._view[self._head:self._tail]
+        self._head, self._tail = 0, size
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import socket
+import struct
+from collections import deque
+from ipaddress import IPv4Address
+from typing import Tuple, Dict, List, Optional
+
+from . import PortType, ProtocolError
+from .binutils import hexify
+from .command import CmdBuilder
+from .protocol import TCP_PACKET_LEN, PORT_CONNECTED, TCPPacket, \
+    UDPPacket, UDP_PORT, DISCOVERY_REQUEST
+from .utils import SupportsLogging
+
+
+class AsyncHDMIMatrix(SupportsLogging):
+    """asyncio-native counterpart of HDMIMatrix built on asyncio streams"""
+    _tag = 'matrix'
+
+    num_out: int = 4
+    num_in: int = 4
+
+    endpoint: Tuple[str, int] = None
+
+    _reader: asyncio.StreamReader = None
+    _writer: asyncio.StreamWriter = None
+    _lock: asyncio.Lock = None
+    _pipelining: bool = False
+    _pipeline_timeout: float = 1.0
+
+    def __init__(self, endpoint: Tuple[IPv4Address, int]):
+        super().__init__(logging.WARNING)
+        self.endpoint = (str(endpoint[0]), endpoint[1])
+
+    async def connect(self) -> None:
+        self._logger.info(f"Connecting to: {self.endpoint}")
+        self._reader, self._writer = await asyncio.open_connection(*self.endpoint)
+        self._lock = asyncio.Lock()
+        self._logger.info(f"Connected to: {self.endpoint}")
+
+    async def disconnect(self) -> None:
+        self._check_connection()
+        self._logger.info(f"Disconnecting from: {self.endpoint}")
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._reader = self._writer = None
+        self._logger.info("Disconnected")
+
+    def pipelining(self, state: bool, timeout: float = None) -> None:
+        """See HDMIMatrix.pipelining"""
+        self._pipelining = state
+        if timeout is not None:
+            self._pipeline_timeout = timeout
+
+    async def get_source_for(self, out_port: int) -> int:
+        self._check_connection()
+        reply, = await self._request_all([CmdBuilder.query_port(out_port)])
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Port mapping: {reply.arg1} -> {reply.arg2}")
+        return reply.arg2
+
+    async def get_input_status(self, in_port: int) -> bool:
+        """:returns True if port is connected, otherwise false"""
+        return await self.get_port_status(in_port, PortType.Input)
+
+    async def get_output_status(self, out_port: int) -> bool:
+        """:returns True if port is connected (HPD signal present), otherwise false"""
+        return await self.get_port_status(out_port, PortType.Output)
+
+    async def get_port_status(self, port: int, _type: PortType) -> bool:
+        self._check_connection()
+        cmd = CmdBuilder.input_status if _type is PortType.Input \
+            else CmdBuilder.output_status
+        reply, = await self._request_all([cmd(port)])
+        return self._parse_status(reply, _type)
+
+    async def get_inputs_status(self) -> Dict[int, bool]:
+        return await self.get_ports_status(PortType.Input)
+
+    async def get_outputs_status(self) -> Dict[int, bool]:
+        return await self.get_ports_status(PortType.Output)
+
+    async def get_ports_status(self, _type: PortType) -> Dict[int, bool]:
+        self._check_connection()
+        count = self.num_in if _type is PortType.Input else self.num_out
+        cmd = CmdBuilder.input_status if _type is PortType.Input \
+            else CmdBuilder.output_status
+        replies = await self._request_all([cmd(i + 1) for i in range(count)])
+        res = {}
+        for i, reply in enumerate(replies):
+            res[i + 1] = self._parse_status(reply, _type)
+        return res
+
+    async def get_port_mapping(self) -> Dict[int, int]:
+        """See HDMIMatrix.get_port_mapping"""
+        self._check_connection()
+        mapping = {}
+        packets = [CmdBuilder.query_port(i + 1) for i in range(self.num_out)]
+        for reply in await self._request_all(packets):
+            mapping[reply.arg1] = reply.arg2
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Port mapping: {mapping}")
+        return mapping
+
+    async def map_port(self, in_port: int, out_port: int):
+        self._check_connection()
+        reply, = await self._request_all([CmdBuilder.map_port(in_port, out_port)])
+        if reply.arg2 != out_port:
+            raise ProtocolError(f"Invalid response, expected {out_port}, got {reply.arg2}")
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Set port mapping: {in_port} -> {out_port}")
+
+    async def map_all(self, in_port: int) -> Dict[int, int]:
+        """See HDMIMatrix.apply_mapping"""
+        return await self.apply_mapping({i + 1: in_port for i in range(self.num_out)})
+
+    async def apply_mapping(self, mapping: Dict[int, int],
+                            current: Dict[int, int] = None) -> Dict[int, int]:
+        """See HDMIMatrix.apply_mapping"""
+        self._check_connection()
+        if current is None:
+            packets = [CmdBuilder.query_port(o) for o in mapping]
+            replies = await self._request_all(packets)
+            current = {o: reply.arg2 for o, reply in zip(mapping, replies)}
+        changes = {o: i for o, i in mapping.items() if current.get(o) != i}
+        packets = [CmdBuilder.map_port(i, o) for o, i in changes.items()]
+        replies = await self._request_all(packets)
+        for (out, _in), reply in zip(changes.items(), replies):
+            if reply.arg2 != out:
+                raise ProtocolError(f"Invalid response, expected {out}, got {reply.arg2}")
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(f"Mapping changes: {changes}")
+        return changes
+
+    def _check_connection(self) -> None:
+        if self._writer is None:
+            raise socket.error("Not connected!")
+
+    def _parse_status(self, reply: TCPPacket, _type: PortType) -> bool:
+        connected = reply.arg2 == PORT_CONNECTED
+        if self._logger.isEnabledFor(logging.INFO):
+            status = "connected" if connected else "not connected"
+            self._logger.info(f"{_type.value.capitalize()} {reply.arg1} is {status}")
+        return connected
+
+    async def _request_all(self, packets: List[bytes]) -> List[TCPPacket]:
+        """See HDMIMatrix._request_all"""
+        async with self._lock:
+            if not self._pipelining or len(packets) < 2:
+                return [await self._request(p) for p in packets]
+
+            pending = {}
+            for i, packet in enumerate(packets):
+                pending.setdefault(TCPPacket.key_of(packet), deque()).append(i)
+            replies = [None] * len(packets)
+
+            data = b''.join(packets)
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(f"SEND >> {hexify(data)}")
+            self._writer.write(data)
+            try:
+                await self._writer.drain()
+                for _ in range(len(packets)):
+                    reply = await asyncio.wait_for(
+                        self._read_packet(), self._pipeline_timeout)
+                    indices = pending.get(reply.key())
+                    if not indices:
+                        raise ProtocolError(f"Unexpected reply: {reply}")
+                    replies[indices.popleft()] = reply
+            except (asyncio.TimeoutError, ProtocolError, ValueError) as e:
+                reason = str(e) or type(e).__name__
+                self._logger.warning(f"Pipelined request failed ({reason}), "
+                                     + "resending unanswered requests one by one")
+                await self._drain()
+
+            for i, packet in enumerate(packets):
+                if replies[i] is None:
+                    replies[i] = await self._request(packet)
+            return replies
+
+    async def _request(self, packet: bytes) -> TCPPacket:
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"SEND >> {hexify(packet)}")
+        self._writer.write(packet)
+        await self._writer.drain()
+        return await self._read_packet()
+
+    async def _read_packet(self) -> TCPPacket:
+        data = await self._reader.readexactly(TCP_PACKET_LEN)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"RECV << {hexify(data)}")
+        return TCPPacket(data)
+
+    async def _drain(self) -> None:
+        """Discards all received data until read timeout occurs"""
+        try:
+            while await asyncio.wait_for(self._reader.read(1024),
+                                         self._pipeline_timeout):
+                pass
+        except asyncio.TimeoutError:
+            pass
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    _queue: asyncio.Queue = None
+    _logger: logging.Logger = None
+
+    def __init__(self, queue: asyncio.Queue, logger: logging.Logger):
+        self._queue = queue
+        self._logger = logger
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if data == DISCOVERY_REQUEST:
+            return  # ignore self-generated packets if we bound to 0.0.0.0
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self._logger.debug(f"Packet received from: {addr}")
+        try:
+            packet = UDPPacket(data)
+        except struct.error as e:
+            self._logger.warning(f"Malformed packet from {addr}: {e}")
+            return
+        if debug:
+            self._logger.debug(f"Message received: {packet}")
+        self._queue.put_nowait(packet)
+
+    def error_received(self, exc: Exception) -> None:
+        self._logger.error(str(exc))
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._queue.put_nowait(None)
+
+
+class AsyncNetworkExplorer(SupportsLogging):
+    """
+    asyncio-native counterpart of NetworkExplorer, found devices are
+    delivered by iterating over explorer with 'async for' statement.
+    Iteration ends when explorer is stopped or all requests are sent
+    and last sender delay is elapsed.
+    """
+    _tag = 'explorer'
+
+    _retry_count = 3
+    _sender_delay = 2.0
+
+    _broadcast: tuple = None
+    _transport: asyncio.DatagramTransport = None
+    _queue: asyncio.Queue = None
+    _sender: asyncio.Task = None
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def retry_count(self, count: int):
+        self._retry_count = count if count > 0 else None
+
+    async def start(self, ip: str) -> None:
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._broadcast = ('255.255.255.255', UDP_PORT)
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryProtocol(self._queue, self._logger),
+            local_addr=(ip, UDP_PORT), allow_broadcast=True,
+            reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+        sockname = self._transport.get_extra_info('sockname')
+        self._logger.info(f"Broadcast socket open at: {sockname}")
+        self._sender = loop.create_task(self._sender_loop())
+
+    def stop(self) -> None:
+        self._logger.info("Stop event received")
+        if self._sender is not None and self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> UDPPacket:
+        if self._queue is None:
+            raise StopAsyncIteration
+        packet = await self._queue.get()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    async def _sender_loop(self) -> None:
+        count = 1
+        while self._retry_count is None or count <= self._retry_count:
+            self._logger.info(f"Sending broadcast ({count}) to: {self._broadcast}")
+            self._transport.sendto(DISCOVERY_REQUEST, self._broadcast)
+            count += 1
+            await asyncio.sleep(self._sender_delay)
+        self.stop()
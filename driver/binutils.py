@@ -3,7 +3,9 @@
 
 import array
 import struct
-from typing import List, Tuple
+from typing import List, Tuple, Optional
+
+_BYTE_ORDERS = '@=<>!'
 
 
 def hexify(data, sep=' ') -> str:
@@ -31,24 +33,25 @@ class BinaryType(metaclass=BinaryMetaType):
     def __init__(self, **kwargs):
         self._kwargs = kwargs
 
-    def to_binary(self, val) -> bytes:
-        pass
-
-    def from_binary(self, binary) -> (int, any):
-        pass
+    def layout(self) -> Tuple[str, str, Optional[int]]:
+        """
+        :returns (byte order, format code, array length) triple used to
+                 compile this type into a flat struct format, array length
+                 is None for types which unpacks to a single value
+        """
+        raise NotImplementedError
 
 
 class SimpleBinaryType(BinaryType):
     def __init__(self, fmt, **kwargs):
         super().__init__(**kwargs)
-        self._struct = struct.Struct(fmt)
-
-    def to_binary(self, val) -> bytes:
-        return self._struct.pack(val)
+        if fmt[0] in _BYTE_ORDERS:
+            self._order, self._code = fmt[0], fmt[1:]
+        else:
+            self._order, self._code = '', fmt
 
-    def from_binary(self, binary) -> (int, any):
-        return (self._struct.size,
-                self._struct.unpack(binary[:self._struct.size])[0])
+    def layout(self) -> Tuple[str, str, Optional[int]]:
+        return self._order, self._code, None
 
 
 @preargs
@@ -57,22 +60,14 @@ class Array(BinaryType):
         super().__init__(**kwargs)
         self._arr_type, self._arr_len = arr_type(**kwargs), arr_len
 
-    def to_binary(self, val):
-        res = []
-        for i, v in enumerate(val):
-            res.append(self._arr_type.to_binary(v))
-            if i+1 == self._arr_len:
-                break
-        return b''.join(res)
-
-    def from_binary(self, binary):
-        res = []
-        ssum = 0
-        for i in range(self._arr_len):
-            s, v = self._arr_type.from_binary(binary[ssum:])
-            ssum += s
-            res.append(v)
-        return ssum, res
+    def layout(self) -> Tuple[str, str, Optional[int]]:
+        order, code, length = self._arr_type.layout()
+        if length is not None:
+            raise TypeError("Nested arrays are not supported")
+        if code == 'B':
+            # byte arrays are packed as a single bytes object
+            return order, f"{self._arr_len}s", None
+        return order, f"{self._arr_len}{code}", self._arr_len
 
 
 class Byte(SimpleBinaryType):
@@ -121,6 +116,29 @@ class BinaryBuilder(dict):
         super().__setitem__(key, value)
 
 
+def compile_members(members: List[Tuple[str, BinaryType]]) \
+        -> Tuple[struct.Struct, List[Tuple[str, int, Optional[int]]]]:
+    """
+    Compiles struct definition into single flat struct format.
+    :returns compiled struct and list of (name, value index, array length)
+             tuples describing how unpacked values maps to members
+    """
+    order = None
+    fmt, fields = [], []
+    index = 0
+    for name, member in members:
+        _order, code, length = member.layout()
+        if _order and order is not None and _order != order:
+            raise TypeError(f"Mixed byte order in struct at '{name}'")
+        order = _order or order
+        fmt.append(code)
+        fields.append((name, index, length))
+        index += 1 if length is None else length
+
+    order = order or '<'
+    return struct.Struct(order + ''.join(fmt)), fields
+
+
 class Binary(type):
     @classmethod
     def __prepare__(mcs, cls, bases, **kwargs):
@@ -131,28 +149,39 @@ class Binary(type):
     def __new__(mcs, name, bases, class_dict):
         # There are nicer ways of doing this, but as a hack it works
         def fixupdict(d):
+            _struct, fields = compile_members(d.members)
+
             # noinspection PyDecorator
             @classmethod
             def to_binary(clas, datadict):
-                res = []
-                for k, v in clas.members:
-                    res.append(v.to_binary(datadict[k]))
-                return b''.join(res)
+                values = []
+                for k, i, length in fields:
+                    v = datadict[k]
+                    if length is not None:
+                        values.extend(v[:length])
+                    elif isinstance(v, (list, tuple)):
+                        values.append(bytes(v))
+                    else:
+                        values.append(v)
+                return _struct.pack(*values)
 
             # noinspection PyDecorator
             @classmethod
             def from_binary(cls, bytes_in):
+                values = _struct.unpack_from(bytes_in)
                 res = {}
-                ssum = 0
-                for k, v in cls.members:
-                    i, _d = v.from_binary(bytes_in[ssum:])
-                    ssum += i
-                    res[k] = _d
-                return ssum, res
+                for k, i, length in fields:
+                    if length is None:
+                        res[k] = values[i]
+                    else:
+                        res[k] = list(values[i:i + length])
+                return _struct.size, res
 
             nd = {'to_binary': to_binary,
                   'from_binary': from_binary,
-                  'members': d.members}
+                  'members': d.members,
+                  'struct': _struct,
+                  'size': _struct.size}
             return nd
 
         return super().__new__(mcs, name, bases, fixupdict(class_dict))
@@ -173,8 +202,11 @@ class BaseStruct(object):
         for k, v in dictionary.items():
             setattr(self, k, v)
 
-    def __bytes__(self):
+    def _dump(self) -> dict:
         data = {}
         for k, _ in self._proto.members:
             data[k] = getattr(self, k)
-        return self._proto.to_binary(data)
+        return data
+
+    def __bytes__(self):
+        return self._proto.to_binary(self._dump())
@@ -0,0 +1,99 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of talking to device while its circuit is open"""
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failed operations with one device. After threshold
+    failures circuit opens and every operation fails immediately for
+    reset_timeout seconds. Then single trial operation is let through
+    (half-open state), its success closes circuit and failure opens it
+    again for another reset_timeout. Trial which has not reported its
+    result within reset_timeout is considered lost and next one is let
+    through.
+    """
+    threshold: int = 5
+    reset_timeout: float = 30.0
+
+    _failures: int = 0
+    _opened_at: float = None
+    _trial: bool = False
+    _trial_at: float = None
+    _lock: Lock = None
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return CLOSED
+            if self._trial or monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return OPEN
+
+    def check(self, trial: bool = True) -> None:
+        """
+        :param trial: whether caller takes trial of half-open circuit,
+                      pass False to only check that circuit is not open,
+                      e.g. before connecting, so that trial is left for
+                      the first operation over new connection
+        :raises CircuitOpenError if operation must not be attempted
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = monotonic()
+            if self._trial and now - self._trial_at >= self.reset_timeout:
+                self._trial = False
+            left = self._opened_at + self.reset_timeout - now
+            if left <= 0 and not self._trial:
+                if trial:
+                    self._trial = True
+                    self._trial_at = now
+                return
+        raise CircuitOpenError(f"Circuit is open, retry in {max(left, 0):.1f} s")
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                self._opened_at = monotonic()
+                self._trial = False
+
+
+_breakers: Dict[Tuple[str, int], CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+
+def breaker_for(endpoint: Tuple[str, int], threshold: int = 5,
+                reset_timeout: float = 30.0) -> CircuitBreaker:
+    """
+    :returns circuit breaker shared by all connections to endpoint, so its
+             state survives reconnects, settings are updated on every call
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(threshold, reset_timeout)
+        breaker.threshold = threshold
+        breaker.reset_timeout = reset_timeout
+        return breaker
@@ -0,0 +1,57 @@
+import time
+from typing import Dict, Iterable, Optional, Tuple, Any
+
+MAPPING = 'mapping'
+INPUT = 'input'
+OUTPUT = 'output'
+
+
+class StateCache(object):
+    """
+    Keeps last known device state split into fields: port mapping
+    (output -> input), input status and output status. Every field has
+    its own TTL in seconds, None means that values never expires.
+    """
+    ttl: Dict[str, Optional[float]] = None
+
+    _values: Dict[str, Dict[int, Tuple[Any, float]]] = None
+
+    def __init__(self, mapping_ttl: Optional[float] = 1.0,
+                 status_ttl: Optional[float] = 1.0):
+        self.ttl = {MAPPING: mapping_ttl,
+                    INPUT: status_ttl,
+                    OUTPUT: status_ttl}
+        self._values = {field: {} for field in self.ttl}
+
+    def get(self, field: str, port: int) -> Optional[Any]:
+        """:returns cached value or None if it is missing or expired"""
+        entry = self._values[field].get(port)
+        if entry is None:
+            return None
+        value, timestamp = entry
+        ttl = self.ttl[field]
+        if ttl is not None and time.monotonic() - timestamp > ttl:
+            del self._values[field][port]
+            return None
+        return value
+
+    def get_all(self, field: str, ports: Iterable[int]) -> Dict[int, Any]:
+        """:returns cached values only for ports which has actual value"""
+        res = {}
+        for port in ports:
+            value = self.get(field, port)
+            if value is not None:
+                res[port] = value
+        return res
+
+    def put(self, field: str, port: int, value: Any) -> None:
+        self._values[field][port] = (value, time.monotonic())
+
+    def invalidate(self, field: str = None, port: int = None) -> None:
+        """Drops cached values of given port or field or all values"""
+        fields = self._values if field is None else [field]
+        for _field in fields:
+            if port is None:
+                self._values[_field].clear()
+            else:
+                self._values[_field].pop(port, None)
@@ -0,0 +1,162 @@
+import mmap
+import socket
+import struct
+import time
+from array import array
+from threading import Lock
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+from .binutils import hexify
+from .protocol import TCP_PACKET_LEN
+
+MAGIC = b'DRHDCAP\x02'
+
+SENT = 0
+RECEIVED = 1
+
+TCP = 0
+UDP = 1
+
+# time (monotonic ns), direction, transport, peer IP, peer port,
+# frame length, followed by the frame itself
+_HEADER = struct.Struct('<QBB4sHH')
+HEADER_SIZE = _HEADER.size
+MAX_FRAME_LEN = 0xffff
+
+# peers which are not IPv4 addresses and cannot be resolved
+_UNKNOWN_IP = bytes(4)
+
+
+class Record(NamedTuple):
+    time: int
+    direction: int
+    transport: int
+    peer: Tuple[str, int]
+    data: bytes
+
+    def __str__(self):
+        arrow = '>>' if self.direction == SENT else '<<'
+        proto = 'TCP' if self.transport == TCP else 'UDP'
+        return f"{self.time / 1e9:.6f} {proto} {arrow} " \
+               f"{self.peer[0]}:{self.peer[1]} {hexify(self.data)}"
+
+
+class Capture(object):
+    """
+    Appends sent and received frames to binary log, every record is
+    header (see HEADER_SIZE) followed by the frame. TCP data is split into
+    separate packets, so pipelined requests are stored one packet per
+    record. Safe to share between devices and explorer running in
+    different threads.
+    """
+    _file = None
+    _lock: Lock = None
+    _addresses: Dict[str, bytes] = None
+
+    def __init__(self, path: str):
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._lock = Lock()
+        self._addresses = {}
+
+    def record(self, direction: int, transport: int,
+               peer: Tuple[str, int], data: bytes) -> None:
+        now = time.monotonic_ns()
+        ip = self._addresses.get(peer[0])
+        if ip is None:
+            ip = self._addresses[peer[0]] = _pack_address(peer[0])
+        size = TCP_PACKET_LEN if transport == TCP else MAX_FRAME_LEN
+        records = []
+        for offset in range(0, max(len(data), 1), size):
+            frame = bytes(data[offset:offset + size])
+            records.append(_HEADER.pack(now, direction, transport, ip,
+                                        peer[1], len(frame)))
+            records.append(frame)
+        with self._lock:
+            self._file.write(b''.join(records))
+
+    def flush(self) -> None:
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class CaptureReader(object):
+    """
+    Memory-maps capture file, records are parsed only when accessed.
+    Offsets of records are found by single pass over headers on first
+    access.
+    """
+    _file = None
+    _map: mmap.mmap = None
+    _offsets: array = None
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"Not a capture file: {path}") from None
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a capture file: {path}")
+
+    def _index(self) -> array:
+        if self._offsets is None:
+            offsets = array('Q')
+            offset, end = len(MAGIC), len(self._map)
+            # incomplete last record is ignored, process may have been killed
+            while offset + HEADER_SIZE <= end:
+                size = _HEADER.unpack_from(self._map, offset)[-1]
+                if offset + HEADER_SIZE + size > end:
+                    break
+                offsets.append(offset)
+                offset += HEADER_SIZE + size
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, index: int) -> Record:
+        return self._parse(self._index()[index])
+
+    def __iter__(self) -> Iterator[Record]:
+        for offset in self._index():
+            yield self._parse(offset)
+
+    def records(self, transport: int = None,
+                peer: Tuple[str, int] = None) -> List[Record]:
+        """:returns records of given transport and peer, None matches any"""
+        return [r for r in self
+                if (transport is None or r.transport == transport)
+                and (peer is None or r.peer == peer)]
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+    def _parse(self, offset: int) -> Record:
+        timestamp, direction, transport, ip, port, size = _HEADER.unpack_from(self._map, offset)
+        start = offset + HEADER_SIZE
+        return Record(timestamp, direction, transport, (socket.inet_ntoa(ip), port),
+                      self._map[start:start + size])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _pack_address(host: str) -> bytes:
+    """:returns packed IPv4 address of host, resolved if it is a name"""
+    try:
+        return socket.inet_aton(socket.gethostbyname(host))
+    except OSError:
+        return _UNKNOWN_IP
@@ -1,39 +1,48 @@
+from functools import lru_cache
+
 from .protocol import TCPPacket, Action, Command, BeepState, ALL_PORTS
 
 
+@lru_cache(maxsize=1024)
+def _frame(group: int, action: int, arg1: int = 0, arg2: int = 0) -> bytes:
+    """:returns ready to send packet, command space is small enough
+                to keep every used packet in cache"""
+    return bytes(TCPPacket.build(group, action, arg1, arg2))
+
+
 class CmdBuilder(object):
 
     @staticmethod
-    def query_port(out_port: int) -> TCPPacket:
-        return TCPPacket.build(Command.Port, Action.Port.Query, out_port)
+    def query_port(out_port: int) -> bytes:
+        return _frame(Command.Port, Action.Port.Query, out_port)
 
     @staticmethod
-    def map_port(in_port: int, out_port: int) -> TCPPacket:
-        return TCPPacket.build(Command.Port, Action.Port.Set, in_port, out_port)
+    def map_port(in_port: int, out_port: int) -> bytes:
+        return _frame(Command.Port, Action.Port.Set, in_port, out_port)
 
     @staticmethod
-    def set_edid(in_port: int, value: int) -> TCPPacket:
+    def set_edid(in_port: int, value: int) -> bytes:
         action = Action.EDID.SetAll if in_port == ALL_PORTS else Action.EDID.Set
-        return TCPPacket.build(Command.EDID, action, value, in_port)
+        return _frame(Command.EDID, action, value, in_port)
 
     @staticmethod
-    def copy_edid(out_port: int, in_port: int) -> TCPPacket:
+    def copy_edid(out_port: int, in_port: int) -> bytes:
         action = Action.EDID.CopyAll if in_port == ALL_PORTS else Action.EDID.Copy
-        return TCPPacket.build(Command.EDID, action, out_port, in_port)
+        return _frame(Command.EDID, action, out_port, in_port)
 
     @staticmethod
-    def output_status(out_port: int) -> TCPPacket:
-        return TCPPacket.build(Command.Status, Action.Status.Output, out_port)
+    def output_status(out_port: int) -> bytes:
+        return _frame(Command.Status, Action.Status.Output, out_port)
 
     @staticmethod
-    def input_status(in_port: int) -> TCPPacket:
-        return TCPPacket.build(Command.Status, Action.Status.Input, in_port)
+    def input_status(in_port: int) -> bytes:
+        return _frame(Command.Status, Action.Status.Input, in_port)
 
     @staticmethod
-    def set_peep(enable: bool) -> TCPPacket:
+    def set_peep(enable: bool) -> bytes:
         state = BeepState.On if enable else BeepState.Off
-        return TCPPacket.build(Command.Setup, Action.Setup.Beeper, state)
+        return _frame(Command.Setup, Action.Setup.Beeper, state)
 
     @staticmethod
-    def query_beep() -> TCPPacket:
-        return TCPPacket.build(Command.Status, Action.Status.Beeper)
+    def query_beep() -> bytes:
+        return _frame(Command.Status, Action.Status.Beeper)
@@ -1,114 +1,309 @@
 import logging
+import selectors
 import socket
+import struct
 import time
+from ipaddress import IPv4Network
 from threading import Event, Thread
-from typing import Callable, Union, SupportsBytes
+from typing import Callable, Union, SupportsBytes, Set, List, Iterator, \
+    Optional, Dict
 
+from . import tracing
+from .capture import Capture, SENT, RECEIVED, UDP
+from .metrics import Metrics, DISCOVERY_REPLIES
+from .netif import Interface
 from .protocol import UDPPacket, UDP_PORT, DISCOVERY_REQUEST
 from .utils import SupportsLogging
 
 
 class NetworkExplorer(SupportsLogging):
+    """
+    Sends discovery requests and dispatches replies to listener from single
+    selector-driven thread. First request is sent immediately, every next
+    one after exponentially growing delay. Explorer stops after replies to
+    the last request were awaited for at least max delay, when expected
+    devices are found or when stop() is called.
+    In sweep mode request round is a series of unicast requests to every
+    host of given networks, sent at limited rate. Networks are swept only
+    once, since repeated rounds would mostly probe hosts without devices,
+    unless explorer runs without retry limit.
+    Requests may be broadcast from several interfaces at once, listener
+    receives every device only once, tagged with interface it was found on.
+    """
     _tag = 'explorer'
 
     _retry_count = 3
-    _sender_delay = 2.0
+    _initial_delay = 0.25
+    _max_delay = 2.0
+    _backoff = 2.0
 
-    _senderThread: Thread = None
-    _finderThread: Thread = None
+    _thread: Thread = None
     _senderPaused: bool = False
     _stopEvent: Event = None
+    _wakeup: tuple = None
+
+    _sweep: List[IPv4Network] = None
+    _rate: float = 5000.0
+    _pending: Iterator[tuple] = None
+    _blocked: tuple = None
+    _tokens: float = 0.0
+    _refilled: float = 0.0
+
+    _expected_mac: str = None
+    _expected_count: int = None
+    _seen: Set[str] = None
 
     _listener: Callable[[UDPPacket], None] = None
-    _broadcast: tuple = None
+    _metrics: Metrics = None
+    _capture: Capture = None
     _socket: socket = None
+    _sockets: Dict[socket.socket, Interface] = None
 
     def __init__(self, listener: Callable[[UDPPacket], None]):
         super().__init__(logging.WARNING)
         self._stopEvent = Event()
         self._listener = listener
 
-    def _receiver_loop(self) -> None:
-        self._logger.info("Receiver thread started")
-        count = 1
+    def _explorer_loop(self) -> None:
+        self._logger.info("Explorer thread started")
+        selector = selectors.DefaultSelector()
+        for sock in self._sockets:
+            selector.register(sock, selectors.EVENT_READ)
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        events = selectors.EVENT_READ
+        count = 0
+        delay = self._initial_delay
+        next_send = time.monotonic()
+        # every round lasts until next one is started or explorer stops
+        round_span = None
 
-        while True:
-            try:
-                if self._dispatch_stop():
-                    self._logger.info("Receiver thread stopped")
-                    break
-
-                if self._socket is None:
-                    raise EOFError("socket is None")
-                self._logger.debug(f"Waiting for server reply ({count})")
-                data, address = self._socket.recvfrom(8192)
-                if data == DISCOVERY_REQUEST:
-                    continue  # ignore self-generated packets if we bound to 0.0.0.0
-                self._logger.debug(f"Packet received from: {address}")
-
-                if data:
-                    data = UDPPacket(data)
-                    self._logger.debug(f"Message received: {data}")
-                    self._listener(data)
-
-                count += 1
-            except (EOFError, socket.error) as e:
-                if self._stopEvent.is_set():
-                    break
-                if type(e) is socket.timeout:
-                    continue
-                self._logger.error(str(e))
-                time.sleep(self._sender_delay)
-                continue
+        try:
+            while not self._stopEvent.is_set():
+                now = time.monotonic()
+                timeout = None
+                if self._pending is not None:
+                    # timeout is None while socket is not writable
+                    timeout = self._send_pending(now)
+                    if self._pending is None:
+                        self._logger.info(f"Sweep ({count}) finished")
+                        next_send = now + self._listen_time(count, delay)
+                        delay = min(delay * self._backoff, self._max_delay)
+                elif now >= next_send:
+                    if self._is_last(count):
+                        self._logger.info("No more requests to send")
+                        break
+                    if not self._senderPaused:
+                        count += 1
+                        tracing.end(round_span, found=len(self._seen))
+                        round_span = tracing.begin('discovery', self._tag, round=count,
+                                                   sweep=self._sweep is not None)
+                        if self._sweep is not None:
+                            self._start_sweep(count, now)
+                            continue
+                        self._send_request(count)
+                    next_send = now + self._listen_time(count, delay)
+                    delay = min(delay * self._backoff, self._max_delay)
+                if self._pending is None:
+                    timeout = max(next_send - now, 0)
+
+                _events = selectors.EVENT_READ
+                if self._blocked is not None:
+                    _events |= selectors.EVENT_WRITE
+                if _events != events:
+                    selector.modify(self._socket, _events)
+                    events = _events
+
+                for key, mask in selector.select(timeout):
+                    if key.fileobj is self._wakeup[0]:
+                        self._wakeup[0].recv(64)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._receive(key.fileobj)
+                    # when socket is writable again, blocked
+                    # request is resent on next iteration
+        finally:
+            tracing.end(round_span, found=len(self._seen))
+            selector.close()
+            self._stopEvent.set()
+            self._close()
+            self._logger.info("Explorer thread stopped")
+
+    def _is_last(self, count: int) -> bool:
+        if self._retry_count is None:
+            return False
+        if self._sweep is not None:
+            return count >= 1
+        return count >= self._retry_count
 
-    def _sender_loop(self) -> None:
-        self._logger.info("Sender thread started")
-        count = 1
+    def _listen_time(self, count: int, delay: float) -> float:
+        """
+        :returns time to wait for replies to given request round, slow
+                 devices must be given enough time to reply to the last one
+        """
+        return max(delay, self._max_delay) if self._is_last(count) else delay
 
-        while True:
+    def _send_request(self, count: int) -> None:
+        for sock, interface in self._sockets.items():
+            broadcast = (str(interface.broadcast), UDP_PORT)
+            self._logger.info(f"Sending broadcast ({count}) to: {broadcast}")
             try:
-                if self._dispatch_stop():
-                    self._logger.info("Sender thread stopped")
-                    break
+                sock.sendto(DISCOVERY_REQUEST, broadcast)
+                if self._capture is not None:
+                    self._capture.record(SENT, UDP, broadcast, DISCOVERY_REQUEST)
+            except socket.error as e:
+                self._logger.error(f"{interface}: {e}")
+
+    def _start_sweep(self, count: int, now: float) -> None:
+        networks = ', '.join([str(n) for n in self._sweep])
+        self._logger.info(f"Starting sweep ({count}) of: {networks}")
+        self._pending = self._sweep_targets()
+        self._tokens = 1.0
+        self._refilled = now
+
+    def _sweep_targets(self) -> Iterator[tuple]:
+        for network in self._sweep:
+            for host in network.hosts():
+                yield str(host), UDP_PORT
 
-                if not self._senderPaused:
-                    self._logger.info(f"Sending broadcast ({count}) to: {self._broadcast}")
-                    self._socket.sendto(DISCOVERY_REQUEST, self._broadcast)
-                    count += 1
+    def _send_pending(self, now: float) -> Optional[float]:
+        """
+        Sends as many sweep requests as rate limit allows.
+        :returns time to wait until next request can be sent
+                 or None if socket is not writable or sweep is over
+        """
+        burst = max(self._rate / 100, 1.0)
+        self._tokens = min(self._tokens + (now - self._refilled) * self._rate, burst)
+        self._refilled = now
+
+        while self._tokens >= 1.0:
+            target = self._blocked or next(self._pending, None)
+            if target is None:
+                self._pending = None
+                return None
+            try:
+                self._socket.sendto(DISCOVERY_REQUEST, target)
+            except BlockingIOError:
+                self._blocked = target
+                return None
+            except socket.error as e:
+                self._logger.debug(f"Unable to send request to {target}: {e}")
+            else:
+                if self._capture is not None:
+                    self._capture.record(SENT, UDP, target, DISCOVERY_REQUEST)
+            self._blocked = None
+            self._tokens -= 1.0
+        return (1.0 - self._tokens) / self._rate
 
+    def _receive(self, sock: socket.socket) -> None:
+        interface = self._sockets[sock]
+        while not self._stopEvent.is_set():
+            try:
+                data, address = sock.recvfrom(8192)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                continue  # ICMP port unreachable, expected in sweep mode
             except socket.error as e:
-                if not self._stopEvent.is_set():
-                    self._logger.error(str(e))
-            finally:
-                time.sleep(self._sender_delay)
-                if self._retry_count is not None \
-                        and count > self._retry_count:
-                    self.stop()
+                self._logger.error(f"{interface}: {e}")
+                return
+
+            if data == DISCOVERY_REQUEST:
+                continue  # ignore self-generated packets if we bound to 0.0.0.0
+            if self._capture is not None:
+                self._capture.record(RECEIVED, UDP, address, data)
+            debug = self._logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self._logger.debug(f"Packet received from {address} on {interface}")
+            try:
+                data = UDPPacket(data)
+            except struct.error as e:
+                self._logger.warning(f"Malformed packet from {address}: {e}")
+                continue
+            if debug:
+                self._logger.debug(f"Message received: {data}")
+            if self._metrics is not None:
+                self._metrics.inc(DISCOVERY_REPLIES,
+                                  interface=str(interface))
+            if data.mac in self._seen:
+                continue  # already found by previous request or on other interface
+            self._seen.add(data.mac)
+            data.interface = interface.name
+            self._listener(data)
+            self._check_expected(data)
+
+    def _check_expected(self, data: UDPPacket) -> None:
+        if self._expected_mac is not None \
+                and data.mac.lower() == self._expected_mac:
+            self._logger.info(f"Expected device found: {data.mac}")
+            self.stop()
+        elif self._expected_count is not None \
+                and len(self._seen) >= self._expected_count:
+            self._logger.info(f"Expected number of devices found: {len(self._seen)}")
+            self.stop()
+
+    def metrics(self, registry: Metrics = None) -> None:
+        """Enables counting of discovery replies per interface"""
+        self._metrics = registry
+
+    def capture(self, capture: Capture = None) -> None:
+        """Enables recording of sent requests and received replies"""
+        self._capture = capture
 
     def retry_count(self, count: int):
         self._retry_count = count if count > 0 else None
 
-    def start(self, ip: str) -> None:
+    def sweep(self, networks: Optional[List[IPv4Network]], rate: float = None) -> None:
+        """
+        Enables sweep mode: instead of broadcast, send unicast request to
+        every host of given networks at most rate requests per second.
+        Pass None to return to broadcast mode.
+        """
+        self._sweep = list(networks) if networks else None
+        if rate is not None:
+            self._rate = rate
+
+    def expect(self, mac: str = None, count: int = None) -> None:
+        """
+        Makes explorer stop as soon as device with given MAC address
+        or given number of distinct devices is found.
+        """
+        self._expected_mac = mac.lower() if mac is not None else None
+        self._expected_count = count
+
+    def start(self, ip: str = '0.0.0.0', interfaces: List[Interface] = None) -> None:
+        """
+        Starts discovery from given address or, if interfaces are given,
+        from all of them, broadcasting to broadcast address of every one
+        """
         self.pause(False)
         self._stopEvent.clear()
-        self._open_socket(ip)
-        self._logger.info("Starting threads...")
-        self._senderThread = Thread(
-            name=self._tag + '-sender',
-            target=self._sender_loop)
-        self._finderThread = Thread(
-            name=self._tag + '-receiver',
-            target=self._receiver_loop)
-        self._senderThread.start()
-        self._finderThread.start()
+        self._seen = set()
+        self._pending = self._blocked = None
+        self._open_sockets(interfaces or [Interface.any(ip)])
+        self._logger.info("Starting thread...")
+        self._thread = Thread(
+            name=self._tag + '-loop',
+            target=self._explorer_loop)
+        self._thread.start()
+
+    def join(self, timeout: float = None) -> None:
+        """Waits until explorer thread is stopped"""
+        if self._thread is not None:
+            self._thread.join(timeout)
 
     def pause(self, state: bool) -> None:
-        self._logger.info(f"Sender thread paused: {state}")
+        self._logger.info(f"Sender paused: {state}")
         self._senderPaused = state
 
     def stop(self) -> None:
         self._logger.info("Stop event received")
         self._stopEvent.set()
+        wakeup = self._wakeup
+        if wakeup is not None:
+            try:
+                wakeup[1].send(b'\0')
+            except socket.error:
+                pass  # already closed by explorer thread
 
     def send(self, data: Union[bytes, SupportsBytes],
              address: tuple) -> None:
@@ -118,21 +313,40 @@ class NetworkExplorer(SupportsLogging):
             data = bytes(data)
         self._socket.sendto(data, address)
 
-    def _open_socket(self, ip: str) -> None:
-        self._broadcast = ('255.255.255.255', UDP_PORT)
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        if hasattr(socket, 'SO_REUSEPORT'):
-            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        if hasattr(socket, 'SO_BROADCAST'):
-            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self._socket.settimeout(self._sender_delay)
-        self._socket.bind((ip, UDP_PORT))
-        self._logger.info(f"Broadcast socket open at: {self._socket.getsockname()}")
-
-    def _dispatch_stop(self) -> bool:
-        if self._stopEvent.is_set():
-            if self._socket is not None:
-                self._socket.close()
-                self._socket = None
-            return True
-        return False
+    def _open_sockets(self, interfaces: List[Interface]) -> None:
+        self._sockets = {}
+        try:
+            for interface in interfaces:
+                self._sockets[self._open_socket(interface)] = interface
+        except socket.error:
+            self._close()
+            raise
+        # used for sweep requests and send()
+        self._socket = next(iter(self._sockets))
+        self._wakeup = socket.socketpair()
+
+    def _open_socket(self, interface: Interface) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if hasattr(socket, 'SO_BROADCAST'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.setblocking(False)
+            sock.bind((str(interface.address), UDP_PORT))
+        except socket.error:
+            sock.close()
+            raise
+        self._logger.info(f"Broadcast socket open at: {sock.getsockname()} ({interface})")
+        return sock
+
+    def _close(self) -> None:
+        if self._sockets is not None:
+            for sock in self._sockets:
+                sock.close()
+            self._sockets = None
+            self._socket = None
+        if self._wakeup is not None:
+            for sock in self._wakeup:
+                sock.close()
+            self._wakeup = None
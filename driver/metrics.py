@@ -0,0 +1,175 @@
+import bisect
+import logging
+from threading import Lock, Thread
+from typing import Any, Dict, List, Tuple
+
+from .protocol import Command, Action
+from .utils import SupportsLogging
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+RTT = 'drhd_command_rtt_seconds'
+CRC_ERRORS = 'drhd_crc_errors'
+PROTOCOL_ERRORS = 'drhd_protocol_errors'
+RECONNECTS = 'drhd_reconnects'
+DISCOVERY_REPLIES = 'drhd_discovery_replies'
+RETRIES = 'drhd_retries'
+CIRCUIT_REJECTIONS = 'drhd_circuit_rejections'
+
+_COUNTERS = {
+    CRC_ERRORS: 'Packets received with invalid CRC',
+    PROTOCOL_ERRORS: 'Unexpected or invalid replies from device',
+    RECONNECTS: 'Connections reopened to the same device',
+    DISCOVERY_REPLIES: 'Valid replies to discovery requests',
+    RETRIES: 'Queries repeated after timeout or invalid reply',
+    CIRCUIT_REJECTIONS: 'Calls rejected because circuit breaker was open',
+}
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _names(cls) -> Dict[int, str]:
+    return {v: k for k, v in vars(cls).items() if not k.startswith('_')}
+
+
+_COMMAND_NAMES = _names(Command)
+_ACTION_NAMES = {code: _names(getattr(Action, name))
+                 for code, name in _COMMAND_NAMES.items()}
+
+
+def command_labels(cmd: int, action: int) -> _Labels:
+    """:returns labels with symbolic command and action names"""
+    command = _COMMAND_NAMES.get(cmd, f"{cmd:#04x}")
+    action = _ACTION_NAMES.get(cmd, {}).get(action, f"{action:#04x}")
+    return ('command', command), ('action', action)
+
+
+class _Histogram(object):
+    counts: List[int] = None
+    sum: float = 0.0
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+
+
+class Metrics(object):
+    """
+    Thread-safe storage of command round trip time histograms and event
+    counters, rendered in OpenMetrics text format. Pass it to objects
+    which support metrics (HDMIMatrix, NetworkExplorer) to enable
+    collection, without it nothing is measured.
+    """
+    buckets: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                  0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    _histograms: Dict[_Labels, _Histogram] = None
+    _counters: Dict[Tuple[str, _Labels], int] = None
+    _lock: Lock = None
+
+    def __init__(self):
+        self._histograms = {}
+        # counters without labels are reported even if nothing happened
+        self._counters = {(name, ()): 0 for name in _COUNTERS
+                          if name != DISCOVERY_REPLIES}
+        self._lock = Lock()
+
+    def observe_rtt(self, cmd: int, action: int, seconds: float) -> None:
+        labels = command_labels(cmd, action)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+
+    def inc(self, name: str, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def value(self, name: str, **labels: str) -> int:
+        """:returns current value of counter"""
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self) -> str:
+        lines = [f"# TYPE {RTT} histogram",
+                 f"# UNIT {RTT} seconds",
+                 f"# HELP {RTT} Round trip time of device commands"]
+        with self._lock:
+            for labels, histogram in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{RTT}_bucket{_format(labels + (('le', le),))} {total}")
+                lines.append(f"{RTT}_count{_format(labels)} {total}")
+                lines.append(f"{RTT}_sum{_format(labels)} {histogram.sum!r}")
+
+            for name, description in _COUNTERS.items():
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"# HELP {name} {description}")
+                for (_name, labels), value in sorted(self._counters.items()):
+                    if _name == name:
+                        lines.append(f"{name}_total{_format(labels)} {value}")
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+
+def _format(labels: _Labels) -> str:
+    if not labels:
+        return ''
+    values = ','.join([f'{k}="{_escape(v)}"' for k, v in labels])
+    return '{' + values + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer(SupportsLogging):
+    """Serves metrics at http://address/metrics from background thread"""
+    _tag = 'metrics'
+
+    _metrics: Metrics = None
+    _server: Any = None
+    _thread: Thread = None
+
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.WARNING)
+        self._metrics = metrics
+
+    def start(self, address: Tuple[str, int]) -> None:
+        # http.server is imported on demand, it is slow to import and
+        # not needed unless metrics are served
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics, logger = self._metrics, self._logger
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt: str, *args) -> None:
+                logger.debug(fmt % args)
+
+        self._server = ThreadingHTTPServer(address, Handler)
+        self._server.daemon_threads = True
+        self._thread = Thread(name=self._tag + '-http', daemon=True,
+                              target=self._server.serve_forever)
+        self._thread.start()
+        self._logger.info(f"Serving metrics at: {self._server.server_address}")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,98 @@
+import socket
+import struct
+from ipaddress import IPv4Address, IPv4Network
+from typing import List, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# Linux ioctl requests, see netdevice(7)
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_SIOCGIFBRDADDR = 0x8919
+_SIOCGIFNETMASK = 0x891b
+
+_IFF_UP = 0x1
+_IFF_BROADCAST = 0x2
+_IFF_LOOPBACK = 0x8
+
+_IFREQ = struct.Struct('16s24x')
+_IFREQ_FLAGS = struct.Struct('16xH')
+_IFREQ_ADDR = struct.Struct('20x4s')
+
+BROADCAST = IPv4Address('255.255.255.255')
+
+
+class Interface(NamedTuple):
+    """Local IPv4 interface which discovery requests are sent from"""
+    name: Optional[str]
+    address: IPv4Address
+    netmask: IPv4Address
+    broadcast: IPv4Address
+
+    @property
+    def network(self) -> IPv4Network:
+        return IPv4Network(f"{self.address}/{self.netmask}", strict=False)
+
+    @staticmethod
+    def any(ip: str = '0.0.0.0') -> 'Interface':
+        """:returns pseudo interface which broadcasts from given address"""
+        return Interface(None, IPv4Address(ip), IPv4Address(0), BROADCAST)
+
+    def __str__(self):
+        return self.name or str(self.address)
+
+
+def list_interfaces(loopback: bool = False) -> List[Interface]:
+    """
+    :returns IPv4 interfaces which are up and have broadcast address,
+             empty list if interfaces can not be enumerated on this platform
+    """
+    if fcntl is None or not hasattr(socket, 'if_nameindex'):
+        return []
+    res = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            try:
+                flags, = _IFREQ_FLAGS.unpack_from(_ioctl(sock, _SIOCGIFFLAGS, name))
+                if not flags & _IFF_UP:
+                    continue
+                if flags & _IFF_LOOPBACK:
+                    if not loopback:
+                        continue
+                elif not flags & _IFF_BROADCAST:
+                    continue
+                address = _ioctl_addr(sock, _SIOCGIFADDR, name)
+                netmask = _ioctl_addr(sock, _SIOCGIFNETMASK, name)
+                if flags & _IFF_LOOPBACK:
+                    broadcast = IPv4Network(f"{address}/{netmask}", strict=False) \
+                        .broadcast_address
+                else:
+                    broadcast = _ioctl_addr(sock, _SIOCGIFBRDADDR, name)
+            except OSError:
+                continue  # interface has no IPv4 address
+            res.append(Interface(name, address, netmask, broadcast))
+    return res
+
+
+def find_interfaces(names: List[str]) -> List[Interface]:
+    """:returns interfaces with given names or addresses"""
+    interfaces = list_interfaces(loopback=True)
+    res = []
+    for name in names:
+        found = [i for i in interfaces if name in (i.name, str(i.address))]
+        if not found:
+            raise LookupError(f"Interface not found: {name}")
+        res.extend(found)
+    return res
+
+
+def _ioctl(sock: socket.socket, request: int, name: str) -> bytes:
+    return fcntl.ioctl(sock.fileno(), request, _IFREQ.pack(name.encode()[:15]))
+
+
+def _ioctl_addr(sock: socket.socket, request: int, name: str) -> IPv4Address:
+    addr, = _IFREQ_ADDR.unpack_from(_ioctl(sock, request, name))
+    return IPv4Address(addr)
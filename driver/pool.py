@@ -0,0 +1,162 @@
+import logging
+import socket
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from ipaddress import IPv4Address
+from threading import Condition
+from typing import Tuple, Callable, Iterator
+
+from . import HDMIMatrix, ProtocolError
+from .utils import SupportsLogging
+
+
+class _PoolEntry(object):
+    endpoint: Tuple[str, int] = None
+    device: HDMIMatrix = None
+    busy: bool = False
+    last_used: float = 0.0
+
+    def __init__(self, endpoint: Tuple[str, int]):
+        self.endpoint = endpoint
+
+
+class MatrixPool(SupportsLogging):
+    """
+    Keeps one persistent connection per device endpoint. Connections which
+    were idle for more than check_interval seconds are checked with cheap
+    query before reuse and reconnected if check fails, connections idle for
+    more than idle_ttl seconds are closed. If pool already holds max_size
+    connections, least recently used idle one is closed to open new one.
+    """
+    _tag = 'pool'
+
+    max_size: int = 16
+    idle_ttl: float = 300.0
+    check_interval: float = 10.0
+    check_timeout: float = 2.0
+    reconnects: int = 0
+
+    _factory: Callable[[Tuple[str, int]], HDMIMatrix] = None
+    _entries: 'OrderedDict[Tuple[str, int], _PoolEntry]' = None
+    _cond: Condition = None
+
+    def __init__(self, max_size: int = 16, idle_ttl: float = 300.0,
+                 check_interval: float = 10.0,
+                 factory: Callable[[Tuple[str, int]], HDMIMatrix] = HDMIMatrix):
+        super().__init__(logging.WARNING)
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.check_interval = check_interval
+        self._factory = factory
+        self._entries = OrderedDict()
+        self._cond = Condition()
+
+    @contextmanager
+    def acquire(self, endpoint: Tuple[IPv4Address, int]) -> Iterator[HDMIMatrix]:
+        """
+        Provides exclusive access to connected device, connection is
+        closed and removed from pool if any communication error occurs.
+        """
+        entry = self._checkout((str(endpoint[0]), endpoint[1]))
+        try:
+            self._prepare(entry)
+            yield entry.device
+        except (socket.error, ProtocolError, ValueError):
+            self._release(entry, broken=True)
+            raise
+        except BaseException:
+            self._release(entry)
+            raise
+        else:
+            self._release(entry)
+
+    def evict_idle(self) -> int:
+        """
+        Closes connections which were idle for more than idle_ttl seconds.
+        :returns number of closed connections
+        """
+        with self._cond:
+            return self._evict_idle()
+
+    def close(self) -> None:
+        with self._cond:
+            for entry in list(self._entries.values()):
+                if not entry.busy:
+                    self._remove(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _checkout(self, endpoint: Tuple[str, int]) -> _PoolEntry:
+        with self._cond:
+            self._evict_idle()
+            while True:
+                entry = self._entries.get(endpoint)
+                if entry is None:
+                    if len(self._entries) >= self.max_size \
+                            and not self._evict_lru():
+                        self._cond.wait()
+                        continue
+                    entry = _PoolEntry(endpoint)
+                    self._entries[endpoint] = entry
+                if entry.busy:
+                    self._cond.wait()
+                    continue
+                entry.busy = True
+                self._entries.move_to_end(endpoint)
+                return entry
+
+    def _release(self, entry: _PoolEntry, broken: bool = False) -> None:
+        with self._cond:
+            entry.busy = False
+            entry.last_used = time.monotonic()
+            if broken:
+                self._logger.warning(f"Connection to {entry.endpoint} is broken")
+                self._remove(entry)
+            self._cond.notify_all()
+
+    def _prepare(self, entry: _PoolEntry) -> None:
+        if entry.device is not None and entry.device.is_connected():
+            if time.monotonic() - entry.last_used < self.check_interval:
+                return
+            try:
+                entry.device.ping(self.check_timeout)
+                return
+            except (socket.error, ProtocolError, ValueError) as e:
+                self._logger.info(f"Health check failed for {entry.endpoint}: {e}")
+                self._close(entry)
+                self.reconnects += 1
+
+        if entry.device is None:
+            entry.device = self._factory(entry.endpoint)
+        entry.device.connect()
+
+    def _evict_idle(self) -> int:
+        now = time.monotonic()
+        expired = [e for e in self._entries.values()
+                   if not e.busy and now - e.last_used > self.idle_ttl]
+        for entry in expired:
+            self._logger.info(f"Evicting idle connection to {entry.endpoint}")
+            self._remove(entry)
+        return len(expired)
+
+    def _evict_lru(self) -> bool:
+        for entry in self._entries.values():
+            if not entry.busy:
+                self._logger.info(f"Evicting connection to {entry.endpoint}")
+                self._remove(entry)
+                return True
+        return False
+
+    def _remove(self, entry: _PoolEntry) -> None:
+        del self._entries[entry.endpoint]
+        self._close(entry)
+
+    def _close(self, entry: _PoolEntry) -> None:
+        if entry.device is None or not entry.device.is_connected():
+            return
+        try:
+            entry.device.disconnect()
+        except socket.error as e:
+            self._logger.warning(str(e))
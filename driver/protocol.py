@@ -4,6 +4,7 @@
 import ipaddress
 import struct
 from ipaddress import IPv4Address
+from typing import Tuple
 
 from .binutils import Binary, Byte, BWord, BDword, BaseStruct, hexify, Word
 
@@ -19,8 +20,18 @@ _TCP_TAIL = b'\x00' * 4
 
 _CRC_BASE = 0x100
 
+_KEY_STRUCT = struct.Struct('<2xBBHH')
+_SIGNED_STRUCTS = {}
+# numpy module used by check_crc_batch, False if it is not installed,
+# imported on first use since it is too heavy for control path
+_numpy = None
+
 ALL_PORTS = 0x00
 PORT_CONNECTED = 0x00
+PORT_DISCONNECTED = 0x01
+
+_UDP_CONST = 80
+_UDP_TAIL = 0x01
 
 
 class Command(object):
@@ -73,14 +84,61 @@ class BeepState(object):
     On = 0x0f
 
 
+def _signed_struct(size: int) -> struct.Struct:
+    fmt = _SIGNED_STRUCTS.get(size)
+    if fmt is None:
+        fmt = _SIGNED_STRUCTS[size] = struct.Struct(f"{size}b")
+    return fmt
+
+
 def calc_crc(data) -> int:
-    data = struct.unpack(f"{len(data)}b", data)
-    crc = _CRC_BASE - sum(data)
-    if crc < 0:
-        while crc < 0:
-            crc += 0xff
-        crc += 1
-    return crc
+    """
+    :returns 0x100 minus sum of given bytes treated as signed, negative
+             result is wrapped into range 1..0xff (by adding 0xff until
+             it becomes non-negative and adding 1), result above 0xff
+             (negative sum) is truncated to its lowest byte
+    """
+    crc = _CRC_BASE - sum(_signed_struct(len(data)).unpack(data))
+    return crc & 0xff if crc >= 0 else crc % 0xff + 1
+
+
+def check_crc_batch(data, size: int = TCP_PACKET_LEN):
+    """
+    Validates CRC of multiple packets of given size stored back to back,
+    CRC is expected in the last byte of every packet.
+    :returns sequence with validation result for every packet: numpy
+             boolean array if numpy is available, otherwise list of bools
+    """
+    if len(data) % size != 0:
+        raise ValueError(f"Data length {len(data)} is not multiple of {size}")
+    count = len(data) // size
+
+    numpy = _load_numpy()
+    if numpy is not None:
+        frames = numpy.frombuffer(data, dtype=numpy.int8).reshape(count, size)
+        crc = _CRC_BASE - frames[:, :-1].sum(axis=1, dtype=numpy.int64)
+        crc = numpy.where(crc >= 0, crc & 0xff, crc % 0xff + 1)
+        return crc == frames[:, -1].view(numpy.uint8)
+
+    fmt = _signed_struct(size - 1)
+    res = []
+    for offset in range(0, len(data), size):
+        crc = _CRC_BASE - sum(fmt.unpack_from(data, offset))
+        crc = crc & 0xff if crc >= 0 else crc % 0xff + 1
+        res.append(crc == data[offset + size - 1])
+    return res
+
+
+def _load_numpy():
+    """:returns numpy module or None if it is not installed, import is tried once"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
 
 
 class _UDPPacket(metaclass=Binary):
@@ -103,8 +161,12 @@ class UDPPacket(BaseStruct):
     gwIP: IPv4Address = None
     netMask: IPv4Address = None
     devPort: int = None
-    const1: int = None
-    res: bytes = None
+    const1: int = _UDP_CONST
+    res: bytes = bytes(32)
+    tail: int = _UDP_TAIL
+
+    # not a part of packet, name of interface packet was received on
+    interface: str = None
 
     def _fill(self, data: dict):
         super()._fill(data)
@@ -113,6 +175,25 @@ class UDPPacket(BaseStruct):
         self.gwIP = ipaddress.ip_address(data['gwIP'])
         self.netMask = ipaddress.ip_address(data['netMask'])
 
+    def _dump(self) -> dict:
+        data = super()._dump()
+        data['mac'] = bytes.fromhex(self.mac.replace(':', ''))
+        data['devIP'] = int(self.devIP)
+        data['gwIP'] = int(self.gwIP)
+        data['netMask'] = int(self.netMask)
+        return data
+
+    @staticmethod
+    def build(mac: str, dev_ip: IPv4Address, gw_ip: IPv4Address,
+              net_mask: IPv4Address, dev_port: int = UDP_PORT):
+        pkt = UDPPacket()
+        pkt.mac = mac.lower()
+        pkt.devIP = IPv4Address(dev_ip)
+        pkt.gwIP = IPv4Address(gw_ip)
+        pkt.netMask = IPv4Address(net_mask)
+        pkt.devPort = dev_port
+        return pkt
+
     def __eq__(self, other):
         if type(other) is not UDPPacket:
             raise NotImplemented
@@ -123,7 +204,14 @@ class UDPPacket(BaseStruct):
 
     def __repr__(self):
         return f"MAC={self.mac}, IP={self.devIP}, GW={self.gwIP}," + \
-            f" MASK={self.netMask}, PORT={self.devPort}"
+            f" MASK={self.netMask}, PORT={self.devPort}" + \
+            (f", IF={self.interface}" if self.interface is not None else "")
+
+
+def _packet_key(cmd: int, action: int, arg1: int, arg2: int) -> Tuple[int, int, int]:
+    if cmd == Command.Port and action == Action.Port.Set:
+        return cmd, action, arg2
+    return cmd, action, arg1
 
 
 class _TCPPacket(metaclass=Binary):
@@ -165,6 +253,19 @@ class TCPPacket(BaseStruct):
         pkt.crc = calc_crc(bytes(pkt)[:-1])
         return pkt
 
+    def key(self) -> Tuple[int, int, int]:
+        """
+        :returns key used to match reply with corresponding request,
+                 port set replies are matched by output number (arg2),
+                 all other by first argument
+        """
+        return _packet_key(self.cmd, self.action, self.arg1, self.arg2)
+
+    @staticmethod
+    def key_of(frame: bytes) -> Tuple[int, int, int]:
+        """:returns the same key as TCPPacket.key for raw packet bytes"""
+        return _packet_key(*_KEY_STRUCT.unpack_from(frame))
+
     def __repr__(self):
         return f"CMD={self.cmd}:{self.action}, " + \
             f"ARGS={self.arg1}:{self.arg2}, CRC={self.crc}"
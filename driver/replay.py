@@ -0,0 +1,216 @@
+import logging
+import socket
+import sys
+import time
+from argparse import ArgumentParser
+from typing import List, NamedTuple, Optional, Tuple
+
+from .binutils import hexify
+from .capture import CaptureReader, Record, SENT, RECEIVED, TCP
+from .protocol import TCP_PACKET_LEN, TCP_PORT
+from .utils import SupportsLogging
+
+
+class ReplayStats(NamedTuple):
+    sent: int
+    received: int
+    mismatched: int
+    missing: int
+    elapsed: float
+    # reason why replay stopped early, None if all records were played
+    error: Optional[str] = None
+
+
+class ReplaySocket(object):
+    """
+    Stands in for TCP socket of HDMIMatrix, see HDMIMatrix.socket_factory.
+    Returns recorded replies in recorded order no matter what is sent,
+    sent data is compared with recorded requests and differences are
+    counted in mismatched. Reads after last reply return end of stream.
+    """
+    mismatched: int = 0
+
+    _sent: List[bytes] = None
+    _replies: List[bytes] = None
+    _pending: bytes = b''
+    _timeout: Optional[float] = None
+
+    def __init__(self, records: List[Record]):
+        self._sent = [r.data for r in records if r.direction == SENT]
+        self._replies = [r.data for r in records if r.direction == RECEIVED]
+        self._sent.reverse()
+        self._replies.reverse()
+
+    def connect(self, address: Tuple[str, int]) -> None:
+        pass
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self._timeout = timeout
+
+    def gettimeout(self) -> Optional[float]:
+        return self._timeout
+
+    def setsockopt(self, *args) -> None:
+        pass
+
+    def send(self, data: bytes) -> int:
+        for offset in range(0, len(data), TCP_PACKET_LEN):
+            frame = bytes(data[offset:offset + TCP_PACKET_LEN])
+            if not self._sent or self._sent.pop() != frame:
+                self.mismatched += 1
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        if not self._pending and self._replies:
+            self._pending = self._replies.pop()
+        size = min(len(self._pending), nbytes or len(buffer))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def recv(self, bufsize: int) -> bytes:
+        data = bytearray(bufsize)
+        return bytes(data[:self.recv_into(data)])
+
+    def close(self) -> None:
+        self._replies.clear()
+        self._pending = b''
+
+
+class Replayer(SupportsLogging):
+    """Replays TCP traffic of capture file, optionally of single device"""
+    _tag = 'replay'
+
+    _records: List[Record] = None
+
+    def __init__(self, reader: CaptureReader, peer: Tuple[str, int] = None):
+        super().__init__(logging.WARNING)
+        self._records = reader.records(TCP, peer)
+
+    def __len__(self):
+        return len(self._records)
+
+    def socket(self, *args) -> ReplaySocket:
+        """Creates fake socket, pass this method to HDMIMatrix.socket_factory"""
+        return ReplaySocket(self._records)
+
+    def play(self, endpoint: Tuple[str, int], speed: float = 1.0,
+             timeout: float = 1.0) -> ReplayStats:
+        """
+        Sends recorded requests to device or simulator and compares its
+        replies with recorded ones.
+        :param speed: time scale, 2.0 plays twice as fast as recorded,
+                      0 sends every request as soon as possible
+        :param timeout: how long to wait for every reply in seconds
+        If connection is lost, replay stops, replies not received yet are
+        counted as missing and the reason is returned in error.
+        """
+        sent = received = mismatched = missing = 0
+        error = None
+        sock = socket.create_connection(endpoint, timeout)
+        try:
+            sock.settimeout(timeout)
+            started = time.monotonic()
+            origin = self._records[0].time if self._records else 0
+            for index, record in enumerate(self._records):
+                if speed > 0:
+                    delay = started + (record.time - origin) / 1e9 / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                try:
+                    if record.direction == SENT:
+                        sock.sendall(record.data)
+                        sent += 1
+                        continue
+                    reply = _recv_exactly(sock, len(record.data))
+                except ConnectionError as e:
+                    error = str(e) or type(e).__name__
+                    missing += sum(1 for r in self._records[index:] if r.direction == RECEIVED)
+                    break
+                if reply is None:
+                    self._logger.warning(f"No reply, expected: {hexify(record.data)}")
+                    missing += 1
+                    continue
+                received += 1
+                if reply != record.data:
+                    self._logger.warning(f"Reply mismatch, expected: "
+                                         f"{hexify(record.data)}, got: {hexify(reply)}")
+                    mismatched += 1
+            elapsed = time.monotonic() - started
+        finally:
+            sock.close()
+        return ReplayStats(sent, received, mismatched, missing, elapsed, error)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    """:returns exactly size bytes or None on timeout"""
+    data = bytearray()
+    try:
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by peer")
+            data += chunk
+    except socket.timeout:
+        return None
+    return bytes(data)
+
+
+def _endpoint(value: str) -> Tuple[str, int]:
+    host, _, port = value.partition(':')
+    return host, int(port) if port else TCP_PORT
+
+
+def main() -> None:
+    parser = ArgumentParser(prog='drhd-replay', allow_abbrev=False,
+                            description='Inspects and replays traffic ' +
+                                        'captured with --capture option')
+    commands = parser.add_subparsers(dest='command', required=True)
+    dump = commands.add_parser('dump', help='print captured frames')
+    dump.add_argument('file', type=str, metavar='FILE')
+    play = commands.add_parser('play', help='send captured requests to device ' +
+                                            'and compare replies')
+    play.add_argument('file', type=str, metavar='FILE')
+    play.add_argument('-e', '--endpoint', type=_endpoint, required=True,
+                      metavar='IP[:PORT]', help='device or simulator to play against')
+    play.add_argument('-P', '--peer', type=_endpoint, metavar='IP[:PORT]',
+                      help='replay traffic of this device only, ' +
+                           'default is all captured TCP traffic')
+    play.add_argument('--speed', type=float, default=1.0,
+                      help='time scale, 0 means as fast as possible, ' +
+                           'default is %(default)s')
+    play.add_argument('-l', '--logging', type=str, metavar='LEVEL', default='warning',
+                      choices=['debug', 'info', 'warning', 'error'])
+    args = parser.parse_args()
+
+    try:
+        reader = CaptureReader(args.file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+        return
+    with reader:
+        if args.command == 'dump':
+            for record in reader:
+                print(record)
+            return
+        replayer = Replayer(reader, args.peer)
+        replayer.logging(args.logging)
+        try:
+            stats = replayer.play(args.endpoint, args.speed)
+        except OSError as e:
+            print(f"Cannot connect to {args.endpoint[0]}:{args.endpoint[1]}: {e}",
+                  file=sys.stderr)
+            sys.exit(1)
+        print(f"Sent {stats.sent}, received {stats.received}, "
+              f"mismatched {stats.mismatched}, missing {stats.missing} "
+              f"in {stats.elapsed:.3f} s")
+        if stats.error is not None:
+            print(f"Replay stopped: {stats.error}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+from typing import Dict, List
+
+from .command import CmdBuilder
+
+
+class Scene(object):
+    """
+    Named port mapping compiled once into map commands. All commands are
+    concatenated into single blob, so recalling scene costs one write
+    and one bulk read (see HDMIMatrix.recall).
+    """
+    name: str = None
+    mapping: Dict[int, int] = None
+    packets: List[bytes] = None
+    data: bytes = None
+
+    def __init__(self, name: str, mapping: Dict[int, int]):
+        """:param mapping: dictionary where keys represents output numbers
+                           and values represents corresponding input numbers"""
+        if not mapping:
+            raise ValueError(f"Scene '{name}' is empty")
+        self.name = name
+        self.mapping = dict(mapping)
+        self.packets = [CmdBuilder.map_port(i, o) for o, i in self.mapping.items()]
+        self.data = b''.join(self.packets)
+
+    def __repr__(self):
+        return f"Scene({self.name}: {self.mapping})"
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import random
+import socket
+from argparse import ArgumentParser
+from ipaddress import IPv4Address, IPv4Network
+from typing import Dict, List, Optional, Tuple
+
+from .protocol import TCPPacket, UDPPacket, Command, Action, BeepState, \
+    TCP_PORT, UDP_PORT, TCP_PACKET_LEN, DISCOVERY_REQUEST, ALL_PORTS, \
+    PORT_CONNECTED, PORT_DISCONNECTED, _TCP_HEADER
+from .utils import SupportsLogging
+
+
+class VirtualMatrix(object):
+    """In-memory model of single matrix which handles protocol requests"""
+    num_out: int = 4
+    num_in: int = 4
+
+    endpoint: Tuple[str, int] = None
+    mac: str = None
+    mapping: Dict[int, int] = None
+    inputs: Dict[int, bool] = None
+    outputs: Dict[int, bool] = None
+    edid: Dict[int, int] = None
+    beeper: bool = True
+
+    def __init__(self, endpoint: Tuple[IPv4Address, int], mac: str):
+        self.endpoint = (str(endpoint[0]), endpoint[1])
+        self.mac = mac
+        self.mapping = {o + 1: o + 1 for o in range(self.num_out)}
+        self.inputs = {i + 1: True for i in range(self.num_in)}
+        self.outputs = {o + 1: True for o in range(self.num_out)}
+        self.edid = {i + 1: 0 for i in range(self.num_in)}
+
+    def handle(self, request: TCPPacket) -> Optional[TCPPacket]:
+        """:returns reply for given request or None if request is unknown"""
+        cmd, action = request.cmd, request.action
+        arg1, arg2 = request.arg1, request.arg2
+
+        if cmd == Command.Port:
+            if action == Action.Port.Query and arg1 in self.mapping:
+                return TCPPacket.build(cmd, action, arg1, self.mapping[arg1])
+            if action == Action.Port.Set and arg1 in self.inputs:
+                for out in self._ports(arg2, self.mapping):
+                    self.mapping[out] = arg1
+                return TCPPacket.build(cmd, action, arg1, arg2)
+        elif cmd == Command.Status:
+            ports = self.inputs if action == Action.Status.Input \
+                else self.outputs if action == Action.Status.Output else None
+            if ports is not None and arg1 in ports:
+                status = PORT_CONNECTED if ports[arg1] else PORT_DISCONNECTED
+                return TCPPacket.build(cmd, action, arg1, status)
+            if action == Action.Status.Beeper:
+                state = BeepState.On if self.beeper else BeepState.Off
+                return TCPPacket.build(cmd, action, arg1, state)
+        elif cmd == Command.EDID:
+            if action in (Action.EDID.Set, Action.EDID.SetAll):
+                for port in self._ports(arg2, self.edid):
+                    self.edid[port] = arg1
+                return TCPPacket.build(cmd, action, arg1, arg2)
+            if action in (Action.EDID.Copy, Action.EDID.CopyAll):
+                # EDID copied from output is not modelled
+                return TCPPacket.build(cmd, action, arg1, arg2)
+        elif cmd == Command.Setup:
+            if action == Action.Setup.Beeper and arg1 in (BeepState.On, BeepState.Off):
+                self.beeper = arg1 == BeepState.On
+                return TCPPacket.build(cmd, action, arg1)
+        return None
+
+    def discovery_reply(self) -> UDPPacket:
+        network = IPv4Network(f"{self.endpoint[0]}/24", strict=False)
+        return UDPPacket.build(self.mac, IPv4Address(self.endpoint[0]),
+                               next(network.hosts()), network.netmask)
+
+    @staticmethod
+    def _ports(port: int, ports: Dict[int, int]) -> List[int]:
+        if port == ALL_PORTS:
+            return list(ports)
+        return [port] if port in ports else []
+
+
+class MatrixSimulator(SupportsLogging):
+    """
+    Hosts any number of virtual matrices on single asyncio event loop.
+    Every reply is delayed by latency +/- jitter seconds (replies within
+    one connection are never reordered) and dropped with drop_rate
+    probability, discovery replies are affected in the same way.
+    """
+    _tag = 'simulator'
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    drop_rate: float = 0.0
+
+    devices: List[VirtualMatrix] = None
+
+    _discovery: Tuple[str, int] = None
+    _servers: List[asyncio.AbstractServer] = None
+    _transport: asyncio.DatagramTransport = None
+    _random: random.Random = None
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 drop_rate: float = 0.0, seed: int = None):
+        super().__init__(logging.WARNING)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.devices = []
+        self._servers = []
+        self._random = random.Random(seed)
+
+    def add_device(self, ip: IPv4Address, port: int = TCP_PORT,
+                   mac: str = None) -> VirtualMatrix:
+        if mac is None:
+            num = len(self.devices) + 1
+            mac = ':'.join(['02', '00'] + [f"{b:02x}" for b in num.to_bytes(4, 'big')])
+        device = VirtualMatrix((ip, port), mac)
+        self.devices.append(device)
+        return device
+
+    def add_devices(self, count: int, base_ip: IPv4Address,
+                    base_port: int = TCP_PORT, same_ip: bool = False) -> None:
+        """
+        Adds multiple devices either on consecutive IP addresses with the
+        same port or on the same IP address with consecutive ports.
+        """
+        base_ip = IPv4Address(base_ip)
+        for i in range(count):
+            if same_ip:
+                self.add_device(base_ip, base_port + i)
+            else:
+                self.add_device(base_ip + i, base_port)
+
+    async def start(self, discovery: Tuple[str, int] = ('0.0.0.0', UDP_PORT)) -> None:
+        loop = asyncio.get_running_loop()
+        for device in self.devices:
+            server = await asyncio.start_server(
+                lambda r, w, d=device: self._serve(d, r, w),
+                *device.endpoint)
+            self._servers.append(server)
+        self._logger.info(f"Started {len(self.devices)} devices")
+
+        if discovery is not None:
+            self._discovery = discovery
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DiscoveryResponder(self), local_addr=discovery,
+                allow_broadcast=True, reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+            self._logger.info(f"Discovery responder started at: {discovery}")
+
+    async def stop(self) -> None:
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers.clear()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self._logger.info("Stopped")
+
+    def _delay(self) -> Optional[float]:
+        """:returns reply delay or None if reply should be dropped"""
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            return None
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0.0)
+
+    async def _serve(self, device: VirtualMatrix, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info('peername')
+        self._logger.debug(f"Client connected to {device.endpoint}: {peer}")
+        buffer = bytearray()
+        last_due = 0.0
+
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                buffer += data
+                while len(buffer) >= TCP_PACKET_LEN:
+                    start = buffer.find(_TCP_HEADER)
+                    if start != 0:
+                        # drop garbage before next packet header
+                        del buffer[:start if start > 0 else len(buffer) - 1]
+                        continue
+                    frame = bytes(buffer[:TCP_PACKET_LEN])
+                    del buffer[:TCP_PACKET_LEN]
+                    try:
+                        reply = device.handle(TCPPacket(frame))
+                    except ValueError as e:
+                        self._logger.warning(f"{device.endpoint}: {e}")
+                        continue
+                    delay = self._delay()
+                    if reply is None or delay is None:
+                        continue
+                    last_due = max(loop.time() + delay, last_due)
+                    loop.call_at(last_due, self._reply, writer, bytes(reply))
+        except ConnectionError as e:
+            self._logger.debug(f"{device.endpoint}: {e}")
+        finally:
+            writer.close()
+            self._logger.debug(f"Client disconnected from {device.endpoint}: {peer}")
+
+    @staticmethod
+    def _reply(writer: asyncio.StreamWriter, data: bytes) -> None:
+        if not writer.is_closing():
+            writer.write(data)
+
+
+class _DiscoveryResponder(asyncio.DatagramProtocol):
+    _simulator: MatrixSimulator = None
+    _transport: asyncio.DatagramTransport = None
+
+    def __init__(self, simulator: MatrixSimulator):
+        self._simulator = simulator
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if data != DISCOVERY_REQUEST:
+            return
+        loop = asyncio.get_running_loop()
+        for device in self._simulator.devices:
+            delay = self._simulator._delay()
+            if delay is None:
+                continue
+            loop.call_later(delay, self._reply, bytes(device.discovery_reply()), addr)
+
+    def _reply(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if not self._transport.is_closing():
+            self._transport.sendto(data, addr)
+
+
+def main() -> None:
+    parser = ArgumentParser(prog='drhd-simulator', allow_abbrev=False,
+                            description='Simulates multiple Dr.HD HDMI matrices')
+    parser.add_argument('-n', '--count', type=int, default=1,
+                        help='number of simulated devices, default is %(default)s')
+    parser.add_argument('-a', '--base-ip', type=IPv4Address, default='127.0.0.1',
+                        help='IP address of first device, default is %(default)s')
+    parser.add_argument('-p', '--base-port', type=int, default=TCP_PORT,
+                        help='TCP port of first device, default is %(default)s')
+    parser.add_argument('-s', '--same-ip', action='store_true',
+                        help='place all devices on the same IP address using ' +
+                             'consecutive ports instead of consecutive addresses')
+    parser.add_argument('-u', '--discovery', type=str, default=f"0.0.0.0:{UDP_PORT}",
+                        metavar='IP:PORT', help='discovery responder address, ' +
+                                                'default is %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='reply latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='reply latency jitter in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='probability of dropped reply (0.0 - 1.0)')
+    parser.add_argument('-l', '--logging', type=str, metavar='LEVEL', default='info',
+                        choices=['debug', 'info', 'warning', 'error'])
+    args = parser.parse_args()
+
+    simulator = MatrixSimulator(args.latency, args.jitter, args.drop_rate)
+    simulator.logging(args.logging)
+    simulator.add_devices(args.count, args.base_ip, args.base_port, args.same_ip)
+    host, port = args.discovery.rsplit(':', 1)
+
+    async def run():
+        await simulator.start((host, int(port)))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await simulator.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
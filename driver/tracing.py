@@ -0,0 +1,143 @@
+import os
+import threading
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional, TextIO
+
+from .binutils import hexify
+
+Args = Dict[str, Any]
+
+
+class Tracer(object):
+    """
+    Receives start and end of spans (connect, requests, discovery rounds,
+    CLI phases). Spans may end on other thread than they were started,
+    token returned by start is passed to end as is.
+    """
+
+    def start(self, name: str, category: str, args: Args) -> Any:
+        """:returns token identifying span"""
+        raise NotImplementedError
+
+    def end(self, token: Any, args: Args = None) -> None:
+        raise NotImplementedError
+
+
+tracer: Optional[Tracer] = None
+
+
+def set_tracer(value: Optional[Tracer]) -> None:
+    """Registers process-wide tracer, None disables tracing"""
+    global tracer
+    tracer = value
+
+
+def begin(name: str, category: str, **args) -> Any:
+    """:returns token for end() or None if tracing is disabled"""
+    if tracer is None:
+        return None
+    return tracer, tracer.start(name, category, args)
+
+
+def end(token: Any, **args) -> None:
+    if token is not None:
+        _tracer, _token = token
+        _tracer.end(_token, args)
+
+
+class _Span(object):
+    __slots__ = ('_name', '_category', '_args', '_token')
+
+    def __init__(self, name: str, category: str, args: Args):
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._token = begin(self._name, self._category, **self._args)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            end(self._token)
+        else:
+            end(self._token, error=exc_type.__name__)
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, category: str, **args):
+    """
+    :returns context manager which traces enclosed block, shared no-op
+             object is returned if tracing is disabled, so arguments
+             must be cheap to pass, they are formatted by tracer only
+    """
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+class ChromeTracer(Tracer):
+    """
+    Collects spans as complete events of Chrome trace event format,
+    result can be opened in chrome://tracing or https://ui.perfetto.dev
+    """
+    _events: List[dict] = None
+    _threads: Dict[int, str] = None
+    _lock: threading.Lock = None
+    _pid: int = None
+
+    def __init__(self):
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def start(self, name: str, category: str, args: Args) -> Any:
+        thread = threading.current_thread()
+        return name, category, args, thread, perf_counter_ns()
+
+    def end(self, token: Any, args: Args = None) -> None:
+        finished = perf_counter_ns()
+        name, category, _args, thread, started = token
+        if args:
+            _args = dict(_args, **args)
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": started / 1000, "dur": (finished - started) / 1000,
+                 "pid": self._pid, "tid": thread.ident,
+                 "args": {k: _format(v) for k, v in _args.items()}}
+        with self._lock:
+            self._events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def dump(self, stream: TextIO) -> None:
+        import json
+        with self._lock:
+            events = list(self._events)
+            events += [{"name": "thread_name", "ph": "M", "pid": self._pid,
+                        "tid": tid, "args": {"name": name}}
+                       for tid, name in self._threads.items()]
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, stream)
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as file:
+            self.dump(file)
+
+
+def _format(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return hexify(value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
@@ -0,0 +1,196 @@
+import socket
+from typing import Callable, Optional, Tuple, BinaryIO, TYPE_CHECKING
+
+from .protocol import TCP_PACKET_LEN, TCPPacket, _TCP_HEADER
+
+if TYPE_CHECKING:
+    from .simulator import VirtualMatrix
+
+
+class Transport(object):
+    """
+    Byte stream between driver and device with socket-like interface.
+    Calls block for at most timeout seconds set by settimeout (None means
+    forever) and raise socket.timeout when it expires, recv_into returns
+    0 when connection is closed by peer. Transport may be connected again
+    after close.
+    """
+
+    def connect(self, timeout: Optional[float]) -> None:
+        raise NotImplementedError
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        raise NotImplementedError
+
+    def sendall(self, data: bytes) -> None:
+        raise NotImplementedError
+
+    def recv_into(self, buffer: memoryview) -> int:
+        """:returns number of received bytes written to buffer"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class TCPTransport(Transport):
+    """
+    TCP connection tuned for small request/reply packets: Nagle's
+    algorithm is disabled, so packets are sent without delay, and
+    keepalive probes detect dead connections of idle devices.
+    """
+    nodelay: bool = True
+    keepalive: bool = True
+    keepalive_idle: int = 30
+    keepalive_interval: int = 10
+    keepalive_count: int = 3
+
+    endpoint: Tuple[str, int] = None
+
+    _factory: Callable[..., socket.socket] = None
+    _socket: socket.socket = None
+
+    def __init__(self, endpoint: Tuple[str, int],
+                 factory: Callable[..., socket.socket] = socket.socket):
+        """:param factory: creates socket, called like socket.socket"""
+        self.endpoint = endpoint
+        self._factory = factory
+
+    def connect(self, timeout: Optional[float]) -> None:
+        sock = self._factory(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.endpoint)
+            self._configure(sock)
+        except socket.error:
+            sock.close()
+            raise
+        self._socket = sock
+
+    def _configure(self, sock: socket.socket) -> None:
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # fine-grained keepalive options are not available everywhere
+            for name, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                                ('TCP_KEEPINTVL', self.keepalive_interval),
+                                ('TCP_KEEPCNT', self.keepalive_count)):
+                if hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self._socket.settimeout(timeout)
+
+    def sendall(self, data: bytes) -> None:
+        self._socket.sendall(data)
+
+    def recv_into(self, buffer: memoryview) -> int:
+        return self._socket.recv_into(buffer)
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class StreamTransport(Transport):
+    """
+    Hook for non-socket links such as serial port adapters. Wraps binary
+    stream returned by opener, for example with pyserial:
+        StreamTransport(lambda timeout: serial.Serial(PORT, 9600, timeout=timeout))
+    If stream has 'timeout' attribute, it is updated on settimeout. Empty
+    read is reported as timeout, streams of such links have no end.
+    """
+    _opener: Callable[[Optional[float]], BinaryIO] = None
+    _stream: BinaryIO = None
+    _timeout: Optional[float] = None
+
+    def __init__(self, opener: Callable[[Optional[float]], BinaryIO]):
+        """:param opener: opens stream, called with connect timeout"""
+        self._opener = opener
+
+    def connect(self, timeout: Optional[float]) -> None:
+        self._stream = self._opener(timeout)
+        self.settimeout(timeout)
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self._timeout = timeout
+        if hasattr(self._stream, 'timeout'):
+            self._stream.timeout = timeout
+
+    def sendall(self, data: bytes) -> None:
+        self._stream.write(data)
+        self._stream.flush()
+
+    def recv_into(self, buffer: memoryview) -> int:
+        size = self._stream.readinto(buffer)
+        if not size:
+            raise socket.timeout("timed out")
+        return size
+
+    def close(self) -> None:
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport bound to simulated device, requests are handled
+    synchronously within sendall, so replies are ready right after it.
+    Reading when no reply is pending raises socket.timeout immediately,
+    as nothing can arrive later. Useful for tests and benchmarks of
+    driver code without sockets and event loop.
+    """
+    device: 'VirtualMatrix' = None
+
+    _input: bytearray = None
+    _output: bytearray = None
+    _connected: bool = False
+
+    def __init__(self, device: 'VirtualMatrix'):
+        self.device = device
+        self._input = bytearray()
+        self._output = bytearray()
+
+    def connect(self, timeout: Optional[float]) -> None:
+        self._input.clear()
+        self._output.clear()
+        self._connected = True
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        pass
+
+    def sendall(self, data: bytes) -> None:
+        if not self._connected:
+            raise ConnectionError("Transport is closed")
+        buffer = self._input
+        buffer += data
+        # the same framing as used by simulator
+        while len(buffer) >= TCP_PACKET_LEN:
+            start = buffer.find(_TCP_HEADER)
+            if start != 0:
+                del buffer[:start if start > 0 else len(buffer) - 1]
+                continue
+            frame = bytes(buffer[:TCP_PACKET_LEN])
+            del buffer[:TCP_PACKET_LEN]
+            try:
+                reply = self.device.handle(TCPPacket(frame))
+            except ValueError:
+                continue
+            if reply is not None:
+                self._output += bytes(reply)
+
+    def recv_into(self, buffer: memoryview) -> int:
+        if not self._connected:
+            return 0
+        if not self._output:
+            raise socket.timeout("timed out")
+        size = min(len(buffer), len(self._output))
+        buffer[:size] = self._output[:size]
+        del self._output[:size]
+        return size
+
+    def close(self) -> None:
+        self._connected = False
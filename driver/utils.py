@@ -2,18 +2,34 @@ import logging
 import sys
 from typing import Union
 
+_FORMAT = "%(asctime)s [%(levelname)s] [%(name)s]: %(message)s"
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Marks handler installed by create_logger"""
+
 
 def create_logger(name: str, level: Union[int, str]):
-    formatter = logging.Formatter("%(asctime)s [%(levelname)s] [%(name)s]: %(message)s")
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
+    """
+    :returns logger with given name, handler is installed and level is
+             set only on first call, so objects sharing the same tag
+             share one handler and do not reset level of each other
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
+    if not any(isinstance(h, _StdoutHandler) for h in logger.handlers):
+        handler = _StdoutHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(_FORMAT))
+        logger.addHandler(handler)
+        logger.setLevel(level)
     return logger
 
 
 class SupportsLogging(object):
+    """
+    Base for objects with own logger, one logger is shared by all objects
+    with the same tag. Messages which are expensive to format or logged
+    per packet or per port must be guarded with _logger.isEnabledFor().
+    """
     _tag: str = "root"
     _logger = None
 
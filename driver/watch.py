@@ -0,0 +1,100 @@
+import logging
+import socket
+from threading import Event
+from typing import Any, Callable, Dict, Optional
+
+from . import HDMIMatrix, ProtocolError
+from .utils import SupportsLogging
+
+State = Dict[str, Dict[int, Any]]
+
+
+class StateWatcher(SupportsLogging):
+    """
+    Polls device state (see HDMIMatrix.get_state) over single connection
+    and passes only changed values to listener. First poll after start
+    reports full state. Poll interval grows by backoff factor after every
+    poll without changes up to max_interval and drops back to
+    min_interval as soon as anything changes. Lost connection is
+    reestablished after max_interval, changes made meanwhile are
+    reported by first successful poll.
+    """
+    _tag = 'watcher'
+
+    _min_interval = 0.25
+    _max_interval = 5.0
+    _backoff = 1.5
+
+    _device: HDMIMatrix = None
+    _listener: Callable[[State], None] = None
+    _state: State = None
+    _interval: float = None
+    _stopEvent: Event = None
+
+    def __init__(self, device: HDMIMatrix, listener: Callable[[State], None]):
+        super().__init__(logging.WARNING)
+        self._device = device
+        self._listener = listener
+        self._stopEvent = Event()
+
+    def intervals(self, min_interval: float, max_interval: float,
+                  backoff: float = None) -> None:
+        self._min_interval = min_interval
+        self._max_interval = max(min_interval, max_interval)
+        if backoff is not None:
+            self._backoff = backoff
+
+    def poll(self) -> Optional[State]:
+        """
+        Reads device state once and notifies listener if it has changed.
+        :returns changed values in the same format as state or None
+        """
+        state = self._device.get_state()
+        if self._state is None:
+            changes = state
+        else:
+            changes = {}
+            for field, values in state.items():
+                old = self._state.get(field, {})
+                diff = {p: v for p, v in values.items() if old.get(p) != v}
+                if diff:
+                    changes[field] = diff
+        self._state = state
+        if not changes:
+            return None
+        self._logger.info(f"State changed: {changes}")
+        self._listener(changes)
+        return changes
+
+    def run(self) -> None:
+        """Polls device until stop() is called, device must be connected"""
+        self._stopEvent.clear()
+        self._state = None
+        self._interval = self._min_interval
+        while not self._stopEvent.is_set():
+            try:
+                if not self._device.is_connected():
+                    self._device.connect(self._max_interval)
+                changed = self.poll() is not None
+            except (socket.error, ProtocolError, ValueError) as e:
+                self._logger.warning(f"Poll failed: {e}")
+                self._close()
+                self._interval = self._max_interval
+            else:
+                if changed:
+                    self._interval = self._min_interval
+                else:
+                    self._interval = min(self._interval * self._backoff,
+                                         self._max_interval)
+            self._logger.debug(f"Next poll in {self._interval:.2f} s")
+            self._stopEvent.wait(self._interval)
+
+    def stop(self) -> None:
+        self._stopEvent.set()
+
+    def _close(self) -> None:
+        if self._device.is_connected():
+            try:
+                self._device.disconnect()
+            except socket.error:
+                pass
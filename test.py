@@ -1,10 +1,28 @@
+import io
 import json
+import logging
+import os
 import random
+import struct
+import socket
+import subprocess
+import sys
+import threading
+import time
 from ipaddress import IPv4Address
+from typing import Dict
 
-from driver import HDMIMatrix
+from cli.batch import BatchRunner
+from driver import HDMIMatrix, protocol
+from driver.breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from driver.capture import Capture, CaptureReader, MAGIC, HEADER_SIZE, SENT, RECEIVED, TCP
 from driver.discovery import NetworkExplorer
-from driver.protocol import UDPPacket, TCP_PORT
+from driver.pool import MatrixPool
+from driver.protocol import UDPPacket, TCPPacket, TCP_PORT, TCP_PACKET_LEN, \
+    Command, calc_crc, check_crc_batch
+from driver.replay import Replayer
+from driver.simulator import VirtualMatrix
+from driver.transport import LoopbackTransport
 
 
 class MatrixTester(object):
@@ -45,6 +63,540 @@ class MatrixTester(object):
         self.device.get_port_mapping()
 
 
+def _legacy_calc_crc(data) -> int:
+    """Original calc_crc implementation, used as reference"""
+    data = struct.unpack(f"{len(data)}b", data)
+    crc = 0x100 - sum(data)
+    if crc < 0:
+        while crc < 0:
+            crc += 0xff
+        crc += 1
+    return crc
+
+
+def _wire_crc(data) -> int:
+    """:returns CRC byte expected on wire, see test_crc_truncation"""
+    return _legacy_calc_crc(data) & 0xff
+
+
+def _signed_frame(length: int, total: int) -> bytes:
+    """:returns frame of given length with given sum of signed bytes"""
+    values = []
+    for i in range(length):
+        left = length - i - 1
+        value = max(-128, min(127, total + 128 * left))
+        value = max(value, total - 127 * left)
+        values.append(value)
+        total -= value
+    return struct.pack(f"{length}b", *values)
+
+
+def test_crc_equivalence():
+    # CRC depends only on sum of signed bytes, so checking every
+    # reachable sum for every length covers all possible inputs,
+    # original values above 0xff are checked by test_crc_truncation
+    for length in range(TCP_PACKET_LEN):
+        for total in range(max(-128 * length, 1), 127 * length + 1):
+            frame = _signed_frame(length, total)
+            assert calc_crc(frame) == _legacy_calc_crc(frame), frame.hex()
+    for a in range(256):
+        for b in range(256):
+            frame = bytes([a, b])
+            if _legacy_calc_crc(frame) > 0xff:
+                continue
+            assert calc_crc(frame) == _legacy_calc_crc(frame), frame.hex()
+            assert calc_crc(memoryview(frame)) == _legacy_calc_crc(frame)
+
+
+def test_crc_truncation():
+    # original implementation returned 0x100 - sum for sums not above
+    # zero, such values do not fit into CRC byte and are truncated
+    for length in range(TCP_PACKET_LEN):
+        for total in range(-128 * length, 1):
+            frame = _signed_frame(length, total)
+            assert _legacy_calc_crc(frame) == 0x100 - total
+            assert calc_crc(frame) == (0x100 - total) & 0xff, frame.hex()
+    # 'beeper off' has negative sum, original codec could not build it
+    frame = bytes(TCPPacket.build(Command.Setup, 0x01, 0xf0))
+    assert frame.hex() == 'a55b0601f00000000000000009'
+    assert TCPPacket(frame).arg1 == 0xf0
+
+
+def test_crc_batch():
+    rnd = random.Random(0)
+    frames, expected = [], []
+    for _ in range(1000):
+        frame = bytes(rnd.randrange(256) for _ in range(TCP_PACKET_LEN - 1))
+        crc = _wire_crc(frame)
+        if rnd.random() < 0.3:
+            crc = (crc + 1) & 0xff
+        frames.append(frame + bytes([crc]))
+        expected.append(crc == _wire_crc(frame))
+    assert list(check_crc_batch(b''.join(frames))) == expected
+    # pure Python implementation, used without numpy
+    numpy, protocol._numpy = protocol._numpy, False
+    try:
+        assert list(check_crc_batch(b''.join(frames))) == expected
+    finally:
+        protocol._numpy = numpy
+
+
+# frames produced by the original field-by-field codec:
+# (cmd, action, arg1, arg2) -> packet bytes
+_TCP_FRAMES = {(0x02, 0x01, 1, 0): 'a55b02010100000000000000fc',
+               (0x02, 0x03, 3, 4): 'a55b02030300040000000000f4',
+               (0x01, 0x04, 2, 0): 'a55b01040200000000000000f9',
+               (0x03, 0x02, 1, 0x0e): 'a55b030201000e0000000000ec'}
+_UDP_FRAME = '020000000001' 'c0a8010a' 'c0a80101' 'ffffff00' '7788' '0050' \
+    + '00' * 32 + '01'
+
+
+def test_codec_layout():
+    for (cmd, action, arg1, arg2), frame in _TCP_FRAMES.items():
+        frame = bytes.fromhex(frame)
+        assert bytes(TCPPacket.build(cmd, action, arg1, arg2)) == frame
+        packet = TCPPacket(frame)
+        assert (packet.cmd, packet.action, packet.arg1, packet.arg2) == \
+            (cmd, action, arg1, arg2)
+        assert bytes(packet) == frame
+
+    frame = bytes.fromhex(_UDP_FRAME)
+    packet = UDPPacket(frame)
+    assert packet.mac == '02:00:00:00:00:01'
+    assert packet.devIP == IPv4Address('192.168.1.10')
+    assert packet.gwIP == IPv4Address('192.168.1.1')
+    assert packet.netMask == IPv4Address('255.255.255.0')
+    assert packet.devPort == 30600
+    assert bytes(packet) == frame
+    assert bytes(UDPPacket.build('02:00:00:00:00:01', packet.devIP,
+                                 packet.gwIP, packet.netMask)) == frame
+
+
+# Import time of 'control -d' code path is compared with import time of
+# reference stdlib modules measured in the same process, so the limit
+# follows the speed of the machine. Typically the ratio is about 2,
+# DRHD_IMPORT_BUDGET overrides the limit.
+_IMPORT_BUDGET = float(os.environ.get('DRHD_IMPORT_BUDGET', 4))
+
+_CONTROL_SCRIPT = """
+from cli import create_cli, MatrixController
+from cli.config import CliConfig
+args = create_cli().parse_args(['--no-daemon', 'control', '-d', '127.0.0.1', '-m', 'A:1'])
+MatrixController(CliConfig(args))._requested_mapping()
+"""
+
+# imported after control script, modules listed before marker are imported by it
+_REFERENCE_MARKER = 'colorsys'
+_REFERENCE_MODULES = ('json', 'xml.dom.minidom', 'http.client')
+_REFERENCE_SCRIPT = f"""
+import {_REFERENCE_MARKER}
+import {', '.join(_REFERENCE_MODULES)}
+"""
+
+
+def _import_times(code: str) -> Dict[str, int]:
+    """
+    :returns cumulative import time in microseconds of every module
+    imported by code, in order of import
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_budget():
+    times = _import_times(_CONTROL_SCRIPT + _REFERENCE_SCRIPT)
+    names = list(times)
+    control = set(names[:names.index(_REFERENCE_MARKER)])
+    for module in ('driver.discovery', 'cli.daemon', 'cli.devices', 'json'):
+        assert module not in control, f"{module} imported by control command"
+    total = times['cli'] + times['driver']
+    reference = sum(times[module] for module in _REFERENCE_MODULES)
+    assert total < _IMPORT_BUDGET * reference, \
+        f"Import time {total / 1000:.1f} ms is over budget, reference {reference / 1000:.1f} ms"
+
+
+def test_single_log_handler():
+    devices = [HDMIMatrix((IPv4Address('127.0.0.1'), TCP_PORT)) for _ in range(100)]
+    devices[0].logging('info')
+    HDMIMatrix((IPv4Address('127.0.0.1'), TCP_PORT))
+    logger = devices[-1]._logger
+    assert len(logger.handlers) == 1
+    assert logger.isEnabledFor(logging.INFO), "level reset by new instance"
+    devices[0].logging('warning')
+
+
+_ENDPOINT = (IPv4Address('127.0.0.1'), TCP_PORT)
+
+
+class _ScriptedLoopback(LoopbackTransport):
+    """
+    Loopback which misbehaves on purpose: replies to single write are
+    reordered, replies to the first 'drop' requests are lost, replies to
+    the next 'late' requests are held until next write, 'garbage' is
+    sent before next replies. In blocking mode reading waits for whole
+    timeout if no reply is pending. Writes are counted.
+    """
+    reverse: bool = False
+    drop: int = 0
+    late: int = 0
+    garbage: bytes = b''
+    blocking: bool = False
+    writes: int = 0
+
+    _held: list = ()
+    _timeout: float = None
+
+    def sendall(self, data: bytes) -> None:
+        self.writes += 1
+        start = len(self._output)
+        super().sendall(data)
+        replies = self._output[start:]
+        del self._output[start:]
+        frames = [replies[i:i + TCP_PACKET_LEN]
+                  for i in range(0, len(replies), TCP_PACKET_LEN)]
+        if self.reverse:
+            frames.reverse()
+        while frames and self.drop > 0:
+            frames.pop(0)
+            self.drop -= 1
+        released, self._held = list(self._held), []
+        while frames and self.late > 0:
+            self._held.append(frames.pop(0))
+            self.late -= 1
+        self._output += self.garbage
+        self.garbage = b''
+        for frame in released + frames:
+            self._output += frame
+
+    def settimeout(self, timeout: float) -> None:
+        self._timeout = timeout
+
+    def recv_into(self, buffer: memoryview) -> int:
+        if self.blocking and not self._output and self._timeout:
+            time.sleep(self._timeout)
+        return super().recv_into(buffer)
+
+
+def _loopback(transport=LoopbackTransport, matrix=VirtualMatrix):
+    """:returns connected driver and simulated device it is bound to"""
+    simulated = matrix(_ENDPOINT, '00:00:00:00:00:01')
+    device = HDMIMatrix(_ENDPOINT)
+    device.transport(transport(simulated))
+    device.connect()
+    return device, simulated
+
+
+def test_loopback_transport():
+    tester = MatrixTester({})
+    tester.device, simulated = _loopback()
+    tester.test_matrix()
+    assert tester.device.get_port_mapping() == simulated.mapping
+    tester.device.pipelining(True)
+    tester.device.map_port(2, 1)
+    assert tester.device.get_port_mapping()[1] == 2
+    tester.device.disconnect()
+
+
+def test_pipelined_replies_matched_by_key():
+    device, simulated = _loopback(_ScriptedLoopback)
+    simulated.mapping.update({1: 3, 2: 4, 3: 1, 4: 2})
+    transport = device._transport
+    transport.reverse = True
+    device.pipelining(True)
+    assert device.get_port_mapping() == {1: 3, 2: 4, 3: 1, 4: 2}
+    assert transport.writes == 1
+    status = device.get_state()
+    assert status['mapping'] == simulated.mapping
+    assert transport.writes == 2
+
+
+def test_pipelining_survives_failed_request():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    device.pipelining(True, timeout=0.01)
+    transport.drop = 1
+    assert device.get_port_mapping() == simulated.mapping
+    # pipelined write and serial resend of single unanswered query
+    assert transport.writes == 2
+    device.get_port_mapping()
+    assert transport.writes == 3
+
+
+def test_apply_mapping_sends_changes_only():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    layout = {1: 2, 2: 2, 3: 3, 4: 1}
+
+    # serial mode: one query per output, then one set per change
+    assert device.apply_mapping(layout) == {1: 2, 4: 1}
+    assert simulated.mapping == layout and transport.writes == 6
+    assert device.apply_mapping(layout) == {}
+    assert transport.writes == 10, "only mapping queries expected"
+    assert device.map_all(2) == {3: 2, 4: 2}
+    assert simulated.mapping == {1: 2, 2: 2, 3: 2, 4: 2}
+
+    # pipelined mode: single query write and single set write
+    device.pipelining(True)
+    writes = transport.writes
+    assert device.apply_mapping(layout) == {3: 3, 4: 1}
+    assert simulated.mapping == layout and transport.writes == writes + 2
+    assert device.apply_mapping(layout) == {}
+    assert transport.writes == writes + 3
+
+    # known mapping is not read at all
+    writes = transport.writes
+    assert device.apply_mapping({1: 1, 2: 2}, current={1: 2, 2: 2}) == {1: 1}
+    assert simulated.mapping[1] == 1 and transport.writes == writes + 1
+
+
+def test_state_cache():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    device.caching(True, mapping_ttl=None, status_ttl=None)
+    assert device.get_port_mapping() == simulated.mapping
+    assert device.get_input_status(1)
+    writes = transport.writes
+    device.get_port_mapping()
+    device.get_source_for(2)
+    device.get_input_status(1)
+    assert transport.writes == writes, "cached values requested again"
+
+    # acknowledged change is stored, nothing is read back
+    device.map_port(3, 2)
+    assert device.get_source_for(2) == 3
+    assert transport.writes == writes + 1
+
+    # change made by other client is seen only after invalidation
+    simulated.mapping[1] = 4
+    assert device.get_source_for(1) == 1
+    device.invalidate('mapping')
+    assert device.get_source_for(1) == 4
+    assert device.get_input_status(1)
+    assert transport.writes == writes + 2
+
+
+class _NoEdidMatrix(VirtualMatrix):
+    """Simulated device which never replies to EDID commands"""
+
+    def handle(self, request: TCPPacket):
+        if request.cmd == Command.EDID:
+            return None
+        return super().handle(request)
+
+
+def test_batch_survives_missing_reply():
+    script = "map A:2\nedid set 1 4\nstatus\n"
+    device, simulated = _loopback(matrix=_NoEdidMatrix)
+    output = io.StringIO()
+    assert BatchRunner(device).run(io.StringIO(script), output) == 1
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line['line'] for line in lines] == [1, 2, 3]
+    assert lines[0]['result'] == {'A': 2}
+    assert 'error' in lines[1]
+    assert lines[2]['result']['mapping']['A'] == 2
+
+    # in pipelined mode the whole chunk is affected
+    device.pipelining(True, timeout=0.01)
+    output = io.StringIO()
+    assert BatchRunner(device, pipelined=True).run(io.StringIO(script), output) == 3
+    assert all('error' in json.loads(line) for line in output.getvalue().splitlines())
+    assert device.is_connected()
+
+
+def test_circuit_breaker_recovers():
+    device, simulated = _loopback(_ScriptedLoopback)
+    device.retry_count(0)
+    device.circuit_breaker(True, threshold=2, reset_timeout=0.05)
+    breaker = device._breaker
+    device._transport.drop = 2
+    for _ in range(2):
+        try:
+            device.get_source_for(1)
+            assert False, "reply is dropped"
+        except socket.timeout:
+            pass
+    assert breaker.state == OPEN
+    try:
+        device.connect()
+        assert False, "circuit is open"
+    except CircuitOpenError:
+        pass
+
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    # reconnect leaves trial to the first request
+    device.connect()
+    assert device.get_source_for(1) == 1
+    assert breaker.state == CLOSED
+    assert device.get_source_for(2) == 2
+
+    # trial which never reports its result does not block circuit forever
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    try:
+        breaker.check()
+        assert False, "trial is in progress"
+    except CircuitOpenError:
+        pass
+    time.sleep(0.06)
+    breaker.check()
+
+
+def test_late_reply_skipped():
+    device, simulated = _loopback(_ScriptedLoopback)
+    device.retry_count(0)
+    device._transport.late = 1
+    try:
+        device.get_source_for(1)
+        assert False, "reply is late"
+    except socket.timeout:
+        pass
+    # late reply to query arrives before acknowledgement of change
+    device.map_port(2, 3)
+    assert simulated.mapping[3] == 2
+    assert device.get_port_mapping() == {1: 1, 2: 2, 3: 2, 4: 4}
+
+
+def test_query_retry():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    transport.drop = 2
+    assert device.get_source_for(2) == 2
+    assert transport.writes == 3
+    # commands which change state are never repeated
+    transport.drop = 1
+    try:
+        device.map_port(1, 2)
+        assert False, "reply is dropped"
+    except socket.timeout:
+        pass
+    assert transport.writes == 4
+
+
+def test_resync_after_garbage():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    # noise, then truncated packet right before reply
+    transport.garbage = b'\x01\x02\xa5\x00' + bytes.fromhex('a55b0201')
+    assert device.get_source_for(1) == 1
+    transport.garbage = b'\xa5'
+    device.map_port(3, 4)
+    assert simulated.mapping[4] == 3
+    assert device.get_port_mapping() == {1: 1, 2: 2, 3: 3, 4: 3}
+    assert transport.writes == 6
+
+
+def test_operation_deadline():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    transport.blocking = True
+    transport.drop = 100
+    device.retry_count(10)
+    device.timeouts(request=0.02, operation=0.05)
+    started = time.monotonic()
+    try:
+        device.get_source_for(1)
+        assert False, "replies are dropped"
+    except socket.timeout:
+        pass
+    assert time.monotonic() - started < 0.15
+    assert transport.writes <= 4
+    transport.drop = 0
+    assert device.get_source_for(1) == 1
+
+
+def test_drain_within_deadline():
+    device, simulated = _loopback(_ScriptedLoopback)
+    transport = device._transport
+    transport.blocking = True
+    transport.drop = 100
+    # draining for whole pipeline timeout after failed batch would overrun deadline
+    device.pipelining(True, timeout=10)
+    device.timeouts(request=0.02, operation=0.05)
+    started = time.monotonic()
+    try:
+        device.get_port_mapping()
+        assert False, "replies are dropped"
+    except socket.timeout:
+        pass
+    assert time.monotonic() - started < 0.15
+    transport.drop = 0
+    assert device.get_port_mapping() == simulated.mapping
+
+
+def test_pool_reuse_and_eviction():
+    created = []
+
+    def factory(endpoint):
+        device = HDMIMatrix(endpoint)
+        device.transport(LoopbackTransport(VirtualMatrix(endpoint, '00:00:00:00:00:01')))
+        created.append(device)
+        return device
+
+    pool = MatrixPool(max_size=2, factory=factory)
+    first, second, third = [(IPv4Address(f'127.0.0.{i}'), TCP_PORT) for i in (1, 2, 3)]
+    with pool.acquire(first) as device:
+        device.get_port_mapping()
+    with pool.acquire(first) as device:
+        assert device is created[0] and device.is_connected()
+    with pool.acquire(second):
+        pass
+    # pool is full, least recently used connection is closed
+    with pool.acquire(third):
+        pass
+    assert len(pool) == 2 and len(created) == 3
+    assert not created[0].is_connected()
+
+    try:
+        with pool.acquire(second):
+            raise ConnectionError("broken")
+    except ConnectionError:
+        pass
+    assert len(pool) == 1 and not created[1].is_connected()
+
+    pool.idle_ttl = 0
+    assert pool.evict_idle() == 1
+    assert len(pool) == 0 and not created[2].is_connected()
+
+
+def test_capture_records(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    capture = Capture(path)
+    device, simulated = _loopback()
+    device.capture(capture)
+    device.pipelining(True)
+    device.get_port_mapping()
+    # peer given by name which cannot be resolved is stored as 0.0.0.0
+    capture.record(SENT, TCP, ('host.invalid', TCP_PORT), b'')
+    capture.close()
+    with CaptureReader(path) as reader:
+        assert len(reader) == 9
+        assert os.path.getsize(path) == len(MAGIC) + 8 * (HEADER_SIZE + TCP_PACKET_LEN) + HEADER_SIZE
+        assert [r.direction for r in reader] == [SENT] * 4 + [RECEIVED] * 4 + [SENT]
+        assert reader[0].peer == device.endpoint and len(reader[0].data) == TCP_PACKET_LEN
+        assert reader[-1].peer == ('0.0.0.0', TCP_PORT) and reader[-1].data == b''
+        replayer = Replayer(reader, device.endpoint)
+    # device which closes connection right after accepting it
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        closer = threading.Thread(target=lambda: server.accept()[0].close())
+        closer.start()
+        stats = replayer.play(server.getsockname(), speed=0)
+        closer.join()
+    assert stats.error is not None
+    assert stats.received == 0 and stats.missing == 4
+
+
 def run():
     with open('./config.json', 'r') as file:
         config = json.load(file)